@@ -0,0 +1,318 @@
+"""The costs recorded in cachegrind profiles (.xp).
+
+Where PHPProfileParser only keeps the file every function is defined in, this reads the
+cost lines and `calls=` edges as well: per function exclusive and inclusive totals of every
+event (Time, Memory, ...) and the caller > callee edges with the number of calls and their cost.
+Everything is stored in NumPy arrays indexed by function id.
+
+    model = ProfileModel.from_files(profile_filenames)
+    for i in model.top('Time', 10):
+        print(model.function_names[i], model.inclusive[i])
+"""
+import sys
+
+import numpy as np
+
+import PHPTraceFiles
+from PHPTraceTokenizer import decode
+
+
+class ProfileModel:
+    def __init__(self, events, function_names, function_files, exclusive, edges, edge_calls, edge_costs, summary):
+        self.events = events
+        """Names of the cost columns, from the `events:` header"""
+
+        self.function_names = function_names
+        self.function_files = function_files
+        """The file every function is defined in, by function id"""
+
+        self.exclusive = exclusive
+        """Cost of every function's own code, one row per function and one column per event"""
+
+        self.edges = edges
+        """(caller, callee) function ids of every call edge"""
+
+        self.edge_calls = edge_calls
+        """Number of calls made along each edge"""
+
+        self.edge_costs = edge_costs
+        """Inclusive cost of the calls made along each edge"""
+
+        self.summary = summary
+        """Totals from the `summary:` header, zero when the profile doesn't have one"""
+
+        # a function calling itself already counted that call in its own totals
+        callers, callees = edges[:, 0], edges[:, 1]
+        outside = callers != callees
+
+        self.inclusive = exclusive.copy()
+        """Cost of every function including everything it called
+
+        Exact for functions that aren't (mutually) recursive. Profiles only have totals per edge,
+        so functions that call each other count the time of their inner calls again, those
+        are capped at the cost of their whole recursive group, which can't be exceeded"""
+        np.add.at(self.inclusive, callers[outside], edge_costs[outside])
+
+        # the time spent in a group of functions that call each other is the time of their
+        # own code plus that of the calls leaving the group, at whatever depth they were made
+        components = _strongly_connected_components(len(function_names), edges)
+        leaving = components[callers] != components[callees]
+        component_costs = np.zeros((len(function_names), exclusive.shape[1]), dtype=np.int64)
+        np.add.at(component_costs, components, exclusive)
+        np.add.at(component_costs, components[callers[leaving]], edge_costs[leaving])
+        np.minimum(self.inclusive, component_costs[components], out=self.inclusive)
+
+        self.invocations = np.bincount(callees, weights=edge_calls, minlength=len(function_names)).astype(np.int64)
+        """Number of times every function was called, the entry point is never called"""
+
+        self._ids = {}
+        for i, name in enumerate(function_names):
+            if self._ids.get(name) is None or function_files[i] != "php:internal":
+                self._ids[name] = i
+
+    def __len__(self):
+        return len(self.function_names)
+
+    @classmethod
+    def from_files(cls, filenames):
+        """Parses one or more profiles of the same request into a single model"""
+        builder = ProfileBuilder()
+        for filename in filenames:
+            with PHPTraceFiles.open_buffer(filename) as buffer:
+                builder.feed(buffer)
+        return builder.build()
+
+    def function_id(self, name):
+        """Id of a function by name, the userland one if php has a function by the same name"""
+        return self._ids[name]
+
+    def event(self, name):
+        """Column of an event by name, `Time` also finds `Time_(10ns)`"""
+        for i, event in enumerate(self.events):
+            if event == name or event.split("_(")[0] == name:
+                return i
+        raise KeyError(name)
+
+    def callees(self, function_id):
+        """Indices into the edge arrays of all calls made by a function"""
+        return np.flatnonzero(self.edges[:, 0] == function_id)
+
+    def callers(self, function_id):
+        """Indices into the edge arrays of all calls made to a function"""
+        return np.flatnonzero(self.edges[:, 1] == function_id)
+
+    def top(self, event, n, inclusive=True):
+        """Ids of the `n` functions with the highest cost for an event, highest first"""
+        costs = (self.inclusive if inclusive else self.exclusive)[:, self.event(event)]
+        return np.argsort(-costs, kind="stable")[:n]
+
+    def function_file_mapping(self):
+        """function name > definition file, like PHPProfileParser.get_function_file_mapping"""
+        return dict(zip(self.function_names, self.function_files))
+
+
+class ProfileBuilder:
+    """Collects the costs of one or more profiles, see ProfileModel.from_files
+
+    Function ids are shared between profiles by name, the compressed `(n)` ids of
+    names and files only hold within a single profile."""
+
+    def __init__(self):
+        self.events = None
+        self.summary = None
+
+        self.function_names = []
+        self.function_files = []
+        self.function_ids = {}
+
+        self.exclusive = []
+        self.edges = {}
+        """(caller, callee) > [calls, costs]"""
+
+    def function(self, name, file):
+        if name is None:
+            raise ValueError("Profile refers to a function that was never named")
+
+        # internal functions keep their `php::` prefix as key, php classes can
+        # have a method with the same name as one in a userland subclass
+        function_id = self.function_ids.get(name)
+        if function_id is None:
+            function_id = self.function_ids[name] = len(self.function_names)
+            if name.startswith("php::") and len(name) > len("php::"):
+                # named like in the traces
+                name = name[len("php::"):]
+            self.function_names.append(name)
+            self.function_files.append(file)
+            self.exclusive.append([0] * len(self.events or ()))
+        elif self.function_files[function_id] is None:
+            self.function_files[function_id] = file
+        return function_id
+
+    def costs(self, line):
+        """The event costs of a cost line, missing trailing costs are 0"""
+        costs = [int(cost) for cost in line.split()[self.positions:]]
+        return costs + [0] * (len(self.events) - len(costs))
+
+    def feed(self, buffer):
+        """Adds the costs of the raw content of a profile"""
+        if buffer.find(b"\x00") != -1:
+            buffer = bytes(buffer).replace(b"\x00", b"")
+
+        files = {}
+        functions = {}
+        self.positions = 1
+
+        fl = None
+        fn = None
+        cfl = None
+        edge = None
+
+        for line in bytes(buffer).split(b"\n"):
+            line = line.rstrip(b"\r")
+            if not line:
+                continue
+
+            while line[3:6] in (b"fl=", b"fn="):
+                # broken `fn=fl=(n)` lines, see PHPProfileParser.consume_line
+                line = line[3:]
+
+            first = line[:1]
+            if first.isdigit() or first in b"+-*":
+                if self.events is None:
+                    raise ValueError("Cost line before the `events:` header in profile")
+                costs = self.costs(line)
+                if edge is not None:
+                    calls_costs = self.edges[edge][1]
+                    for i, cost in enumerate(costs):
+                        calls_costs[i] += cost
+                    edge = None
+                    cfl = None
+                elif fn is not None:
+                    exclusive = self.exclusive[fn]
+                    for i, cost in enumerate(costs):
+                        exclusive[i] += cost
+            elif line.startswith(b"fl="):
+                fl = _compressed(files, line[3:])
+            elif line.startswith((b"fi=", b"fe=")):
+                # inlined code, only matters for the file of the following cost lines
+                _compressed(files, line[3:])
+            elif line.startswith(b"fn="):
+                fn = self.function(_compressed(functions, line[3:]), fl)
+            elif line.startswith((b"cfl=", b"cfi=")):
+                cfl = _compressed(files, line[4:])
+            elif line.startswith(b"cfn="):
+                callee = self.function(_compressed(functions, line[4:]), cfl if cfl is not None else fl)
+                edge = (fn, callee)
+            elif line.startswith(b"calls="):
+                if edge is None:
+                    raise ValueError("`calls=` line without a `cfn=` line in profile")
+                self.edges.setdefault(edge, [0, [0] * len(self.events)])[0] += int(line[6:].split()[0])
+            elif b":" in line:
+                key, _, value = decode(line).partition(":")
+                self.header(key.strip(), value.split())
+
+    def header(self, key, value):
+        if key == "events":
+            if self.events is not None and self.events != value:
+                raise ValueError("Profiles with different events can't be combined")
+            self.events = value
+            for exclusive in self.exclusive:
+                exclusive.extend([0] * (len(value) - len(exclusive)))
+        elif key == "positions":
+            self.positions = len(value)
+        elif key in ("summary", "totals"):
+            summary = [int(cost) for cost in value]
+            if self.summary is None:
+                self.summary = summary
+            else:
+                self.summary = [a + b for a, b in zip(self.summary, summary)]
+
+    def build(self):
+        events = self.events or []
+        size = len(events)
+
+        edges = list(self.edges.items())
+        return ProfileModel(
+            events,
+            self.function_names,
+            self.function_files,
+            np.array(self.exclusive, dtype=np.int64).reshape(len(self.function_names), size),
+            np.array([edge for edge, _ in edges], dtype=np.int64).reshape(len(edges), 2),
+            np.array([calls for _, (calls, _) in edges], dtype=np.int64),
+            np.array([costs for _, (_, costs) in edges], dtype=np.int64).reshape(len(edges), size),
+            np.array(self.summary or [0] * size, dtype=np.int64)
+        )
+
+
+def _strongly_connected_components(size, edges):
+    """Component id of every function, functions that (indirectly) call each other share one
+
+    Tarjan's algorithm, without recursion since call chains can be deep"""
+    callees = [[] for _ in range(size)]
+    for caller, callee in edges.tolist():
+        callees[caller].append(callee)
+
+    components = np.full(size, -1, dtype=np.int64)
+    index = [-1] * size
+    lowlink = [0] * size
+    on_stack = [False] * size
+    stack = []
+    counter = 0
+    component = 0
+
+    for root in range(size):
+        if index[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, i = work.pop()
+            if i == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            if i < len(callees[node]):
+                work.append((node, i + 1))
+                callee = callees[node][i]
+                if index[callee] == -1:
+                    work.append((callee, 0))
+                elif on_stack[callee]:
+                    lowlink[node] = min(lowlink[node], index[callee])
+                continue
+
+            if lowlink[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    components[member] = component
+                    if member == node:
+                        break
+                component += 1
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+    return components
+
+
+def _compressed(names, spec):
+    """Resolves cachegrind name compression
+
+    `(n) name` defines id n, `(n)` refers back to it and anything else is a plain name"""
+    if spec.startswith(b"("):
+        end = spec.find(b")")
+        key = spec[1:end]
+        name = spec[end + 1:].strip()
+        if name:
+            names[key] = decode(name)
+        return names.get(key)
+    return decode(spec.strip())
+
+
+if __name__ == "__main__":
+    model = ProfileModel.from_files(sys.argv[1:])
+    time = model.event("Time")
+
+    print("{:>14} {:>14} {:>8}  {}".format("inclusive", "exclusive", "calls", "function"))
+    for i in model.top("Time", 25):
+        print("{:>14} {:>14} {:>8}  {}".format(model.inclusive[i, time], model.exclusive[i, time], model.invocations[i], model.function_names[i]))
@@ -6,6 +6,11 @@ import re
 import sys
 from pprint import pprint
 
+import PHPTraceFiles
+
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+"""Bytes of a compressed profile that are decompressed and scanned at a time, see `parse`"""
+
 
 class PHPProfilerParser:
     def __init__(self):
@@ -13,6 +18,14 @@ class PHPProfilerParser:
         self.flRegex = re.compile("fl=\((?P<num>\d+)\)( (?P<fl>.+))?")
         self.fnflRegex = re.compile("f[nl]=f[nl]=\((?P<num>\d+)\)")
 
+        # for scanning a whole profile at once, see `scan`
+        self.definitionRegex = re.compile(rb"\nf([ln])=\((\d+)\) ([^\r\n]+)")
+        self.contextRegex = re.compile(rb"fl=\((\d+)\)")
+        self.definitionsRegex = re.compile(
+            rb"^(?:f[nl]=f[nl]=\((\d+)\)|fl=\((\d+)\)(?: ([^\r\n]+))?|fn=\((\d+)\)(?: (?:php::)?([^\r\n]+))?)",
+            re.MULTILINE
+        )
+
         self.context = None
 
         self.files = {}
@@ -20,8 +33,89 @@ class PHPProfilerParser:
 
 
     def parse(self, filename):
-        for line in open(filename):
-            self.consume_line(line)
+        if PHPTraceFiles.is_compressed(filename):
+            # streamed, a chunk of whole lines at a time, instead of decompressed as a whole
+            with PHPTraceFiles.open_binary(filename) as f:
+                while True:
+                    chunk = f.read(SCAN_CHUNK_SIZE) + f.readline()
+                    if not chunk:
+                        break
+                    # definitions are found after a newline, the first line of a chunk is no exception
+                    self.scan(b"\n" + chunk)
+            return
+
+        with PHPTraceFiles.open_buffer(filename) as buffer:
+            self.scan(buffer)
+
+    def scan(self, buffer):
+        """Extracts all fl= and fn= definitions from the raw content of a profile at once
+
+        Gives the same result as feeding every line to `consume_line`, but all other
+        lines (costs, calls, references without a name) are skipped by the regex engine"""
+        if buffer.find(b"\x00") != -1:
+            buffer = bytes(buffer).replace(b"\x00", b"")
+
+        if not self.scan_definitions(buffer):
+            self.scan_all(buffer)
+
+    def scan_definitions(self, buffer):
+        """The fast path, only looks at lines that define a name
+
+        xdebug always writes the fl= line of a function right before its fn= line,
+        so that line gives the context. Returns False, without changing anything,
+        for profiles where that doesn't hold."""
+        if buffer[:3] in (b"fl=", b"fn=") or buffer.find(b"\nfn=f") != -1 or buffer.find(b"\nfl=f") != -1:
+            return False
+
+        files = dict(self.files)
+        functions = {}
+
+        for match in self.definitionRegex.finditer(buffer):
+            kind, num, name = match.groups()
+            # decoded like trace fields, so the names match those in the traces
+            name = name.decode("utf-8", errors="ignore")
+
+            if kind == b"l":
+                files[num.decode()] = name
+                continue
+
+            line_start = buffer.rfind(b"\n", 0, match.start()) + 1
+            context = self.contextRegex.match(buffer, line_start, match.start())
+            if context is None:
+                return False
+
+            if name.startswith("php::") and len(name) > len("php::"):
+                name = name[len("php::"):]
+
+            try:
+                functions[num.decode()] = (name, files[context.group(1).decode()])
+            except KeyError as e:
+                print("Function fn=({}) is defined in an unknown file".format(num.decode()))
+                raise e
+
+        last_context = buffer.rfind(b"\nfl=(")
+        if last_context != -1:
+            self.context = self.contextRegex.match(buffer, last_context + 1).group(1).decode()
+        self.files = files
+        self.functions.update(functions)
+        return True
+
+    def scan_all(self, buffer):
+        """The slow path, visits every fl= and fn= line in order"""
+        for context, fl_num, fl, fn_num, fn in self.definitionsRegex.findall(buffer):
+            if context:
+                self.context = context.decode()
+            elif fl_num:
+                fl_num = fl_num.decode()
+                if fl:
+                    self.files[fl_num] = fl.decode("utf-8", errors="ignore")
+                self.context = fl_num
+            elif fn:
+                try:
+                    self.functions[fn_num.decode()] = (fn.decode("utf-8", errors="ignore"), self.files[self.context])
+                except KeyError as e:
+                    print("Function fn=({}) is defined in an unknown file".format(fn_num.decode()))
+                    raise e
 
     def consume_line(self, line):
         line = line.replace("\x00", "")
@@ -4,12 +4,15 @@ import argparse
 import os
 
 import PHPTraceTokenizer
-import PHPProfileParser
+import PHPTraceCache
 import cmd
-import PHPTraceParser
+import PHPTraceTable
+import PHPTraceIndex
+from PHPTraceParser import indent_level
 import sys
 import os.path
 import re
+from pathlib import Path
 
 from settings import *
 
@@ -34,8 +37,12 @@ class PHPTraceAnalyser(cmd.Cmd):
         tracefile = os.path.join(traceDir, "{}.xt".format(args.timestamp))
         profileFile = os.path.join(traceDir, "{}.xp".format(args.timestamp))
 
-        function_mappings = PHPProfileParser.get_function_file_mapping(profileFile)
+        # both are read from the sidecar cache after the first session
+        function_mappings = PHPTraceCache.load_function_mappings([profileFile])
         self.trace = PHPTraceTokenizer.Trace(tracefile, function_mappings)
+        self.table = PHPTraceCache.load_trace_table(self.trace)
+        # every command is answered from this index, the trace isn't scanned again
+        self.index = PHPTraceIndex.TraceIndex(self.table)
 
     def do_exit(self, line):
         """Exit the cli"""
@@ -90,43 +97,127 @@ call_tree is interesting""")
     def do_show_filenames(self, line):
         """Prints all files that were run during this trace
         Optionally pass a regex as a filter"""
-        paths = list(PHPTraceParser.filenames(self.trace))
+        paths = list(PHPTraceTable.filenames(self.table))
         prefix = os.path.commonprefix(paths)
         print("There are {n} paths, and they're all found under {p}".format(n=len(paths),p=prefix))
 
-        prog = re.compile(line)
+        try:
+            prog = re.compile(line)
+        except re.error as e:
+            print("Not a valid regex: {}".format(e))
+            return
 
         for file in paths:
             f = file.replace(prefix, "")
             if prog.match(f):
                 print(f)
 
+    def print_call_tree(self, calls):
+        """Prints the given calls indented by their stack-depth"""
+        index = self.index
+        stems = [Path(filename).stem for filename in self.table.filenames]
+
+        for i in calls:
+            row = index.rows[i]
+            print(indent_level(int(index.level[i])), row, "{0}:{1}@{2}".format(
+                stems[index.filename_id[i]],
+                self.table.line_number[row],
+                self.table.function_names[index.function_id[i]]
+            ))
+
+    def print_calls(self, calls):
+        """Prints the given calls along with their parameters and return values"""
+        print("\n".join([
+            "{name}({params}) -> {ret}".format(
+                name=call['name'],
+                params=call['parameters'],
+                ret=call['return']
+            )
+            for call in calls
+        ]))
+
     def do_call_tree(self, line):
         """Display a simple indented call-tree"""
-        PHPTraceParser.call_tree(self.trace)
+        self.print_call_tree(range(len(self.index)))
+
+    def do_subtree(self, line):
+        """Display the call-tree below a single call
+        Pass the number call_tree shows in front of the call"""
+        try:
+            i = self.index.call_at_row(int(line))
+        except (ValueError, KeyError):
+            print("There is no call numbered {}".format(line))
+            return
+
+        self.print_call_tree(self.index.subtree(i))
 
     def do_function_names(self, line):
         """Display the names of all functions"""
-        functions = PHPTraceParser.function_names(self.trace)
+        functions = PHPTraceTable.function_names(self.table)
         print("\n".join([fn[0] for fn in functions]))
 
     def do_function_calls(self, line):
         """Display all function calls along with their respective
         parameters and return values"""
 
-        calls = PHPTraceParser.function_calls(self.trace)
+        self.print_calls(self.index.calls())
 
-        print("\n".join([
-            "{name}({params}) -> {ret}".format(
+    def do_calls(self, line):
+        """Display all calls of a single function along with their
+        parameters and return values"""
+        self.print_calls(self.index.calls(self.index.calls_to(line.strip())))
+
+    def do_calls_from(self, line):
+        """Display all calls made from files matching a regex"""
+        try:
+            prog = re.compile(line)
+        except re.error as e:
+            print("Not a valid regex: {}".format(e))
+            return
+        filename_ids = [i for i, filename in enumerate(self.table.filenames) if prog.search(filename)]
+        self.print_calls(self.index.calls(self.index.calls_from(filename_ids)))
+
+    def do_slowest(self, line):
+        """Display the N slowest calls, 10 by default"""
+        try:
+            n = int(line) if line.strip() else 10
+            if n < 1:
+                raise ValueError(line)
+        except ValueError:
+            print("Usage: slowest [N], N being at least 1")
+            return
+
+        for i in self.index.slowest(n):
+            call = self.index.call(int(i))
+            print("{time:.6f}s {memory:>12}b  {name}  {file}:{line}".format(
+                time=call['time_delta'],
+                memory=call['memory_delta'],
                 name=call['name'],
-                params=call['parameters'],
-                ret=call['return']
-            )
-            for call in calls
-        ]))
+                file=call['calling_filename'],
+                line=call['line_number']
+            ))
+
+    def do_function_stats(self, line):
+        """Display the N functions with the highest total time, 10 by default"""
+        try:
+            n = int(line) if line.strip() else 10
+            if n < 1:
+                raise ValueError(line)
+        except ValueError:
+            print("Usage: function_stats [N], N being at least 1")
+            return
+        aggregates = self.index.aggregates
+
+        for function_id in aggregates['time'].argsort()[::-1][:n]:
+            print("{time:.6f}s {memory:>12}b {count:>8}x  {name}".format(
+                time=aggregates['time'][function_id],
+                memory=aggregates['memory'][function_id],
+                count=aggregates['count'][function_id],
+                name=aggregates['name'][function_id]
+            ))
 
     def do_grouped_function_calls(self, line):
-        calls = PHPTraceParser.grouped_function_calls(self.trace)
+        calls = self.index.grouped_calls()
 
         for name, calls in calls.items():
             print(name)
@@ -143,7 +234,7 @@ call_tree is interesting""")
                     retval = '{{void}}'
 
                 formatted_call = "{params:40}->\t{ret}".format(
-                    params=parameters,
+                    params=str(parameters),
                     ret=retval
                 )
 
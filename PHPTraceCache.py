@@ -0,0 +1,133 @@
+"""Sidecar caches for parsed traces and profiles.
+
+Parsing a trace or profile is by far the slowest part of analysing it, so the results are
+stored in a cache directory next to the original files. Every cache file records the path,
+size and modification time of the files it was built from and is rebuilt when they change.
+"""
+import json
+import os
+
+import numpy as np
+
+import PHPProfileParser
+from PHPTraceTable import TraceTable
+
+CACHE_DIRECTORY = ".autotest-cache"
+
+CACHE_VERSION = 1
+"""Bump this whenever the layout of a cache file changes"""
+
+
+def file_identity(paths):
+    """Identifies the exact version of a set of files"""
+    identity = []
+    for path in paths:
+        stat = os.stat(path)
+        identity.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return identity
+
+
+def cache_path(path, suffix):
+    """Where the cache of a trace or profile file lives"""
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, CACHE_DIRECTORY, filename + suffix)
+
+
+def _write_atomically(path, write):
+    """Caches are replaced in one go, so a concurrent reader never sees half a file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, path)
+
+
+def _read_table(sidecar, identity, function_mappings):
+    with np.load(sidecar, allow_pickle=False) as data:
+        meta = json.loads(data['meta'].tobytes().decode("utf-8"))
+        if meta['version'] != CACHE_VERSION or meta['identity'] != identity:
+            return None
+
+        return TraceTable(
+            {name: data[name] for name in TraceTable.COLUMNS},
+            meta['function_names'],
+            meta['filenames'],
+            data['heap'].tobytes(),
+            data['heap_offsets'],
+            function_mappings
+        )
+
+
+def _write_table(sidecar, identity, table):
+    meta = json.dumps({
+        'version': CACHE_VERSION,
+        'identity': identity,
+        'function_names': table.function_names,
+        'filenames': table.filenames,
+    }).encode("utf-8")
+
+    _write_atomically(sidecar, lambda f: np.savez(
+        f,
+        meta=np.frombuffer(meta, dtype=np.uint8),
+        heap=np.frombuffer(table.heap, dtype=np.uint8),
+        heap_offsets=table.heap_offsets,
+        **table.columns()
+    ))
+
+
+def load_trace_table(trace):
+    """The TraceTable of a PHPTraceTokenizer.Trace, read from its sidecar cache when it is up to date"""
+    sidecar = cache_path(trace.path, ".table.npz")
+    identity = None
+
+    try:
+        identity = file_identity([trace.path])
+        table = _read_table(sidecar, identity, trace.function_mappings)
+        if table is not None:
+            return table
+    except (OSError, KeyError, ValueError):
+        # missing or unreadable cache, it gets rebuilt below
+        pass
+
+    table = TraceTable.from_trace(trace)
+    if identity is None:
+        # the trace couldn't be looked at, a cache of it would never be up to date
+        return table
+    try:
+        _write_table(sidecar, identity, table)
+    except OSError as e:
+        print("Could not write trace cache {}: {}".format(sidecar, e))
+
+    return table
+
+
+def load_function_mappings(profile_filenames):
+    """Same result as PHPProfileParser.get_function_file_mapping, cached next to the first profile
+
+    Profiles are optional, the ones that don't exist are left out"""
+    profile_filenames = [path for path in profile_filenames if os.path.exists(path)]
+    if not profile_filenames:
+        return PHPProfileParser.get_function_file_mapping(profile_filenames)
+
+    sidecar = cache_path(profile_filenames[0], ".mapping.json")
+    identity = None
+
+    try:
+        identity = file_identity(profile_filenames)
+        with open(sidecar, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached['version'] == CACHE_VERSION and cached['identity'] == identity:
+            return cached['mapping']
+    except (OSError, KeyError, ValueError):
+        pass
+
+    mapping = PHPProfileParser.get_function_file_mapping(profile_filenames)
+    if identity is None:
+        return mapping
+    cached = json.dumps({'version': CACHE_VERSION, 'identity': identity, 'mapping': mapping}).encode("utf-8")
+    try:
+        _write_atomically(sidecar, lambda f: f.write(cached))
+    except OSError as e:
+        print("Could not write profile cache {}: {}".format(sidecar, e))
+
+    return mapping
@@ -0,0 +1,64 @@
+"""Opening trace and profile files, which xdebug can also write compressed.
+
+Compressed files are decompressed while they are read, never as a whole,
+except by `open_buffer`.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import mmap
+import os
+from contextlib import contextmanager
+
+COMPRESSED_OPENERS = {
+    ".gz": gzip.GzipFile,
+    ".bz2": bz2.BZ2File,
+    ".xz": lzma.LZMAFile,
+}
+"""Openers for the compression formats that are recognised by their file extension"""
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in COMPRESSED_OPENERS
+
+
+def strip_compression_suffix(filename):
+    """`request.xt.gz` -> `request.xt`"""
+    if is_compressed(filename):
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def open_binary(path, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """Opens a, possibly compressed, file for buffered binary reading"""
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1])
+    if opener is None:
+        return open(path, "rb", buffering=buffer_size)
+    return io.BufferedReader(opener(path, "rb"), buffer_size)
+
+
+def open_text(path):
+    """Opens a, possibly compressed, file for reading lines of text like the builtin open"""
+    return io.TextIOWrapper(open_binary(path))
+
+
+@contextmanager
+def open_buffer(path):
+    """The whole, decompressed, content of a file as one buffer
+
+    Uncompressed files are memory mapped instead of read, compressed ones are
+    decompressed into memory as a whole, stream those through `open_binary` where it matters"""
+    if is_compressed(path):
+        with open_binary(path) as f:
+            yield f.read()
+        return
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            yield b""
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
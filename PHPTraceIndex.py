@@ -0,0 +1,148 @@
+"""An indexed, in-memory view of a TraceTable.
+
+Built once per trace so interactive questions (calls of a function, calls made from a file,
+the subtree below a call, the slowest calls) are answered without another pass over the trace.
+Calls are numbered in the order they were made, like PHPTraceTable.ordered_function_calls.
+"""
+import numpy as np
+
+from PHPLangUtils import PHP_INST_VOID
+
+
+def _group(keys, size):
+    """Indices of `keys` grouped by key value, as an ordering plus per-key boundaries
+
+    The sort is stable, so within a group the indices stay in call order"""
+    order = np.argsort(keys, kind="stable")
+    boundaries = np.searchsorted(keys[order], np.arange(size + 1))
+    return order, boundaries
+
+
+class TraceIndex:
+    def __init__(self, table):
+        self.table = table
+
+        entries, exits, returns, time_end, memory_end, time_delta, memory_delta = table.call_deltas()
+        self.rows = entries
+        """Table row of the Entry of every call"""
+
+        self.return_rows = returns
+        self.exited = exits >= 0
+        self.time_delta = time_delta
+        self.memory_delta = memory_delta
+        self.time_end = time_end
+        self.memory_end = memory_end
+
+        self.level = table.level[entries]
+        self.function_id = table.function_id[entries]
+        self.filename_id = table.filename_id[entries]
+
+        self.parent, self.subtree_end = self._link(self.level.tolist())
+        """The calling call of every call (-1 for the outer ones), and the end of its subtree"""
+
+        self._by_name = _group(self.function_id, len(table.function_names))
+        self._by_file = _group(self.filename_id, len(table.filenames))
+
+        self.aggregates = table.function_aggregates()
+        self.definition_filenames = table.definition_filenames()
+
+        self._calls = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def _link(levels):
+        """Calls are in pre-order, so a stack of levels is enough to find every parent"""
+        parent = np.full(len(levels), -1, dtype=np.int64)
+        subtree_end = np.full(len(levels), len(levels), dtype=np.int64)
+        stack = []
+
+        for i, level in enumerate(levels):
+            while stack and levels[stack[-1]] >= level:
+                subtree_end[stack.pop()] = i
+            if stack:
+                parent[i] = stack[-1]
+            stack.append(i)
+
+        return parent, subtree_end
+
+    def call(self, i):
+        """The call record of call `i`, the same dict ordered_function_calls produces"""
+        if i not in self._calls:
+            table = self.table
+            row = int(self.rows[i])
+            function_id = int(self.function_id[i])
+            exited = bool(self.exited[i])
+            return_row = int(self.return_rows[i])
+
+            self._calls[i] = {
+                'name': table.function_names[function_id],
+                'parameters': table.params(row),
+                'calling_filename': table.filenames[self.filename_id[i]],
+                'definition_filename': self.definition_filenames[function_id],
+                'line_number': str(table.line_number[row]),
+                'return': table.return_value(return_row) if return_row >= 0 and table.function_num[row] != 0 else PHP_INST_VOID,
+                'memory_start': int(table.memory[row]),
+                'memory_end': int(self.memory_end[i]) if exited else -1,
+                'memory_delta': int(self.memory_delta[i]) if exited else -1,
+                'time_start': float(table.time_index[row]),
+                'time_end': float(self.time_end[i]) if exited else -1,
+                'time_delta': float(self.time_delta[i]) if exited else -1
+            }
+
+        return self._calls[i]
+
+    def calls(self, indices=None):
+        """Call records of the given calls, all calls by default"""
+        if indices is None:
+            indices = range(len(self))
+        return [self.call(int(i)) for i in indices]
+
+    def call_at_row(self, row):
+        """The call whose Entry is table row `row`, as numbered by call_tree"""
+        i = int(np.searchsorted(self.rows, row))
+        if i == len(self.rows) or self.rows[i] != row:
+            raise KeyError(row)
+        return i
+
+    def subtree(self, i):
+        """Call `i` and everything it called, in call order"""
+        return np.arange(i, self.subtree_end[i])
+
+    def calls_to(self, name):
+        """All calls of a function by name"""
+        try:
+            function_id = self.table.function_names.index(name)
+        except ValueError:
+            return np.array([], dtype=np.int64)
+
+        order, boundaries = self._by_name
+        return order[boundaries[function_id]:boundaries[function_id + 1]]
+
+    def calls_from(self, filename_ids):
+        """All calls made from any of the given files"""
+        order, boundaries = self._by_file
+        return np.sort(np.concatenate(
+            [order[boundaries[i]:boundaries[i + 1]] for i in filename_ids] or [np.array([], dtype=np.int64)]
+        ))
+
+    def slowest(self, n):
+        """The `n` calls that took the longest, slowest first"""
+        times = np.where(self.exited, self.time_delta, -np.inf)
+        return np.argsort(-times, kind="stable")[:n]
+
+    def grouped_calls(self):
+        """All call records grouped by function name, in order of first call"""
+        grouped = {}
+        order, boundaries = self._by_name
+        first_calls = sorted(
+            (order[boundaries[function_id]], function_id)
+            for function_id in range(len(self.table.function_names))
+            if boundaries[function_id] < boundaries[function_id + 1]
+        )
+        for _, function_id in first_calls:
+            grouped[self.table.function_names[function_id]] = self.calls(
+                order[boundaries[function_id]:boundaries[function_id + 1]]
+            )
+        return grouped
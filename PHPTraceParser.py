@@ -1,6 +1,11 @@
 """Functions to analyse parsed PHP traces with."""
+import os
 from pprint import pprint
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import PHPTraceTokenizer
 from PHPLangUtils import PHP_INST_VOID
 
 
@@ -33,13 +38,13 @@ def indent_level(level):
 
 
 def call_tree(trace):
-    for field, i in trace.visit(filter_entry):
+    for field, i in trace.visit(filter_entry, kinds={"Entry"}):
         print(indent_level(field.level), i, "{0}:{1}@{2}".format(field.filename.stem, field.line_number, field.function_name))
 
 
 def function_names(trace):
     functions = set()
-    for field, i in trace.visit(filter_entry):
+    for field, i in trace.visit(filter_entry, kinds={"Entry"}):
         functions.add((field.function_name + "\t" + field.definition_filename, ))
         # print(indent_level(field.level), i, get_fn_name(field.function_name))
 
@@ -50,7 +55,7 @@ def function_calls(trace):
     calls = []
 
     stack = []
-    for field, i in trace.visit(lambda f: filter_entry(f) or filter_return(f)):
+    for field, i in trace.visit(lambda f: filter_entry(f) or filter_return(f), kinds={"Entry", "Return"}):
         if filter_entry(field):
             _currentCall = {
                 'name': field.function_name,
@@ -71,32 +76,45 @@ def function_calls(trace):
     return calls
 
 
+def _call_from_entry(field):
+    """The call record that ordered_function_calls builds for an Entry
+
+    `function_num` numbers the calls of a trace in the order they were entered"""
+    return {
+        'function_num': field.function_num,
+        'name': field.function_name,
+        'parameters': field.params,
+        'calling_filename': str(field.filename),
+        'definition_filename': str(field.definition_filename),
+        'line_number': field.line_number,
+        'return': PHP_INST_VOID,
+        'memory_start': field.memory,
+        'memory_end': -1,
+        'memory_delta': -1,
+        'time_start': field.time_index,
+        'time_end': -1,
+        'time_delta': -1
+    }
+
+
+def _exit_call(call, time_index, memory):
+    """Completes a call record with the time and memory at its Exit"""
+    call['memory_end'] = memory
+    call['time_end'] = time_index
+    call['time_delta'] = time_index - call['time_start']
+    call['memory_delta'] = memory - call['memory_start']
+
+
 def ordered_function_calls(trace):
     calls = {}
 
     for field, i in trace.visit(lambda _: True):
         if filter_entry(field):
-            calls[field.function_num] = {
-                'name': field.function_name,
-                'parameters': field.params,
-                'calling_filename': str(field.filename),
-                'definition_filename': str(field.definition_filename),
-                'line_number': field.line_number,
-                'return': PHP_INST_VOID,
-                'memory_start': field.memory,
-                'memory_end': -1,
-                'memory_delta': -1,
-                'time_start': field.time_index,
-                'time_end': -1,
-                'time_delta': -1
-            }
+            calls[field.function_num] = _call_from_entry(field)
             # print("entry:", field.function_num)
         elif filter_exit(field):
             # print("exit:", field.function_num)
-            calls[field.function_num]['memory_end'] = field.memory
-            calls[field.function_num]['time_end'] = field.time_index
-            calls[field.function_num]['time_delta'] = field.time_index - calls[field.function_num]['time_start']
-            calls[field.function_num]['memory_delta'] = field.memory - calls[field.function_num]['memory_start']
+            _exit_call(calls[field.function_num], field.time_index, field.memory)
         elif filter_return(field):
             retval = getattr(field, 'return_value', PHP_INST_VOID)
 
@@ -111,11 +129,211 @@ def ordered_function_calls(trace):
     return calls.values()
 
 
+INCLUDE_FUNCTIONS = {"include", "include_once", "require", "require_once"}
+
+
+class TraceDefinitions:
+    """function_mappings that fill in what `known` (a profile) doesn't have
+
+    Learns where functions are defined from the trace itself: the calls a user defined
+    function makes are made from the file it's defined in, functions that aren't user
+    defined are internal and closures carry their file in their name.
+    Only the calls built after a function's children were seen can use what they taught,
+    such as the ones of iter_ordered_function_calls."""
+
+    def __init__(self, known=None, learned=None):
+        self.known = known if known is not None else {}
+        self.learned = learned if learned is not None else {}
+        self.stack = []
+        """(level, function name) of the learnable calls that enclose the current one"""
+
+    def learn(self, field):
+        """Consumes the Entry records of the trace, in order"""
+        while self.stack and self.stack[-1][0] >= field.level:
+            self.stack.pop()
+
+        if self.stack and self.stack[-1][1] is not None:
+            self.learned.setdefault(self.stack[-1][1], field.filename)
+            # the first child is enough
+            self.stack[-1] = (self.stack[-1][0], None)
+
+        name = field.function_name
+        if name in INCLUDE_FUNCTIONS:
+            # named like PHPProfileParser.get_function_file_mapping does
+            self.learned[name] = "php::internal"
+        elif not field.is_function_user_defined:
+            self.learned[name] = "php:internal"
+        elif "{closure:" in name and name.endswith("}"):
+            # {closure:PATH:linenums}
+            self.learned[name] = name[name.index("{closure:") + len("{closure:"):-1].rsplit(":", 1)[0]
+
+        if field.is_function_user_defined and name not in INCLUDE_FUNCTIONS and name not in self.learned:
+            self.stack.append((field.level, name))
+        else:
+            self.stack.append((field.level, None))
+
+    def get(self, function_name, default=None):
+        definition = self.known.get(function_name)
+        if definition is None:
+            definition = self.learned.get(function_name, default)
+        return definition
+
+
+class CallStack:
+    """The state of iter_ordered_function_calls: the calls that are still open
+    and the last finished call, which might still receive a Return
+
+    `learn` is given every Entry, see TraceDefinitions"""
+
+    def __init__(self, learn=None):
+        self.open_calls = {}
+        self.finished = None
+        self.learn = learn
+
+    def feed(self, field):
+        """Consumes a single record, yields the calls it completes"""
+        if self.finished is not None:
+            function_num, call = self.finished
+            self.finished = None
+
+            if filter_return(field) and field.function_num == function_num:
+                # main is recorded as a function call, its return stays void
+                if function_num != 0:
+                    call['return'] = field.return_value
+                yield call
+                return
+
+            yield call
+
+        if filter_entry(field):
+            self.open_calls[field.function_num] = field
+            if self.learn is not None:
+                self.learn(field)
+        elif filter_exit(field):
+            call = _call_from_entry(self.open_calls.pop(field.function_num))
+            _exit_call(call, field.time_index, field.memory)
+            # hold on to it, the Return follows right after the Exit
+            self.finished = (field.function_num, call)
+
+    def close(self):
+        """Yields everything that is left once the trace has ended"""
+        if self.finished is not None:
+            yield self.finished[1]
+            self.finished = None
+
+        for field in self.open_calls.values():
+            yield _call_from_entry(field)
+        self.open_calls = {}
+
+
+def iter_ordered_function_calls(trace):
+    """Streaming version of ordered_function_calls
+
+    Only the calls that are still open are kept in memory, every call is
+    yielded as soon as its Exit and (optional) Return have been seen.
+    Calls therefore come out in the order they finished, not in the order
+    they were entered. Calls that never exit are yielded at the end."""
+    stack = CallStack(getattr(trace.function_mappings, 'learn', None))
+
+    for field in trace.parse():
+        yield from stack.feed(field)
+
+    yield from stack.close()
+
+
+class TraceTail:
+    """Follows a trace file that is still being written
+
+    Every poll only tokenizes the bytes appended since the previous one and
+    yields the calls that completed, like iter_ordered_function_calls would.
+    The byte offset and the open call stack are kept in between polls.
+    Compressed traces can't be followed, their streams are only readable once complete."""
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.offset = 0
+        self.stack = CallStack(getattr(trace.function_mappings, 'learn', None))
+
+    def poll(self):
+        """Yields the calls completed by the lines appended since the last poll
+
+        A trailing line that is still being written is left for the next poll"""
+        for line in self.trace.raw_lines(self.offset):
+            if not line.endswith(b"\n"):
+                break
+            self.offset += len(line)
+
+            field = PHPTraceTokenizer.parse_line(line, self.trace.function_mappings)
+            if field is not None:
+                yield from self.stack.feed(field)
+
+    def close(self):
+        """Reads whatever is left and yields every remaining call, for when the trace is complete"""
+        yield from self.poll()
+        yield from self.stack.close()
+
+
+def _ordered_function_calls_chunk(path, function_mappings, start, end):
+    """Collects the calls of one byte range of a trace in a worker process
+
+    Exits and returns of calls that were entered in an earlier chunk can't be
+    matched here, their records are handed back in order so they can be stitched on."""
+    trace = PHPTraceTokenizer.Trace(path, function_mappings)
+    calls = {}
+    unmatched = []
+
+    for field in trace.parse(start, end):
+        if filter_entry(field):
+            calls[field.function_num] = _call_from_entry(field)
+        elif field.function_num not in calls:
+            unmatched.append(field)
+        elif filter_exit(field):
+            _exit_call(calls[field.function_num], field.time_index, field.memory)
+        else:
+            calls[field.function_num]['return'] = field.return_value
+
+    return calls, unmatched
+
+
+def parallel_ordered_function_calls(trace, processes=None, chunks_per_process=4):
+    """Same result as ordered_function_calls, but the trace file is split
+    at line boundaries and the chunks are tokenized in a process pool"""
+    processes = processes or os.cpu_count() or 1
+    starts, ends = zip(*trace.split(processes * chunks_per_process))
+
+    calls = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunks = executor.map(
+            partial(_ordered_function_calls_chunk, trace.path, trace.function_mappings),
+            starts,
+            ends
+        )
+
+        # stitching happens in file order, so every unmatched exit or
+        # return belongs to a call of a chunk that's already merged
+        for chunk_calls, unmatched in chunks:
+            for field in unmatched:
+                if filter_exit(field):
+                    _exit_call(calls[field.function_num], field.time_index, field.memory)
+                else:
+                    calls[field.function_num]['return'] = field.return_value
+
+            calls.update(chunk_calls)
+
+    try:
+        # main is recorded as a function call
+        calls[0]['return'] = PHP_INST_VOID
+    except KeyError:
+        pass
+
+    return calls.values()
+
+
 def grouped_function_calls(trace):
     calls = {}
 
     stack = []
-    for field, i in trace.visit(lambda f: filter_entry(f) or filter_return(f)):
+    for field, i in trace.visit(lambda f: filter_entry(f) or filter_return(f), kinds={"Entry", "Return"}):
         if filter_entry(field):
             _currentCall = {
                 'name': field.function_name,
@@ -144,7 +362,7 @@ def grouped_function_calls(trace):
 def filenames(trace):
     files = []
 
-    for field, i in trace.visit(lambda f: filter_entry(f)):
+    for field, i in trace.visit(lambda f: filter_entry(f), kinds={"Entry"}):
         name = str(field.filename)
         if name not in files:
             files.append(name)
@@ -0,0 +1,334 @@
+"""Columnar representation of a PHP trace.
+
+Instead of building an object per line (PHPTraceTokenizer.Trace), every column of the
+trace is stored in a NumPy array. Function names and filenames are integer-coded and
+parameters and return values live in one shared string heap, only decoded when asked for.
+
+    table = TraceTable.from_trace(trace)
+    calls = ordered_function_calls(table)
+"""
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from PHPLangUtils import infer_type, PHP_INST_VOID
+from PHPTraceParser import indent_level
+from PHPTraceTokenizer import PARAMS_FIELD, decode, is_trace_metadata
+
+KIND_ENTRY = 0
+KIND_EXIT = 1
+KIND_RETURN = 2
+
+_KINDS = {b'0': KIND_ENTRY, b'1': KIND_EXIT, b'R': KIND_RETURN}
+
+
+class TraceTable:
+    COLUMNS = (
+        'level', 'function_num', 'kind', 'time_index', 'memory', 'function_id', 'filename_id',
+        'line_number', 'is_function_user_defined', 'value_start', 'value_count'
+    )
+
+    def __init__(self, columns, function_names, filenames, heap, heap_offsets, function_mappings):
+        self.level = columns['level']
+        """the stack-depth starting at 0"""
+
+        self.function_num = columns['function_num']
+        """Each invocation's unique index, shared by its Entry, Exit and Return row"""
+
+        self.kind = columns['kind']
+        """KIND_ENTRY, KIND_EXIT or KIND_RETURN"""
+
+        self.time_index = columns['time_index']
+        """Time since the start of the trace, only meaningful for entries and exits"""
+
+        self.memory = columns['memory']
+        """Memory usage in bytes, only meaningful for entries and exits"""
+
+        self.function_id = columns['function_id']
+        """Index into `function_names`, -1 for exits and returns"""
+
+        self.filename_id = columns['filename_id']
+        """Index into `filenames` of the calling file, -1 for exits and returns"""
+
+        self.line_number = columns['line_number']
+        """Line number of the call, -1 for exits and returns"""
+
+        self.is_function_user_defined = columns['is_function_user_defined']
+        """Whether the function is defined in php, always False for exits and returns"""
+
+        self.value_start = columns['value_start']
+        """Index of the first heap string of this row, its parameters or its return value"""
+
+        self.value_count = columns['value_count']
+        """Number of heap strings belonging to this row"""
+
+        self.function_names = function_names
+        self.filenames = filenames
+        self.function_mappings = function_mappings
+
+        self.heap = heap
+        """All raw parameters and return values, back to back"""
+
+        self.heap_offsets = heap_offsets
+        """Boundaries of the strings in `heap`, string `n` is heap[offsets[n]:offsets[n + 1]]"""
+
+    def __len__(self):
+        return len(self.kind)
+
+    def columns(self):
+        """All per-row arrays by name, the counterpart of the `columns` constructor argument"""
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    @classmethod
+    def from_trace(cls, trace):
+        """Reads a PHPTraceTokenizer.Trace into a TraceTable without creating per-line objects"""
+        level = array('q')
+        function_num = array('q')
+        kind = array('b')
+        time_index = array('d')
+        memory = array('q')
+        function_id = array('i')
+        filename_id = array('i')
+        line_number = array('i')
+        user_defined = array('b')
+        value_start = array('q')
+        value_count = array('i')
+
+        heap = bytearray()
+        heap_offsets = array('q', [0])
+
+        function_ids = {}
+        filename_ids = {}
+
+        for line in trace.raw_lines():
+            if line.endswith(b"\r\n"):
+                line = line[:-2] + b"\n"
+
+            info = line.split(b"\t", PARAMS_FIELD)
+            record_kind = _KINDS.get(info[2]) if len(info) > 2 else None
+
+            if record_kind is None:
+                if len(info) > 2 or is_trace_metadata(line):
+                    continue
+                raise ValueError("Could not parse trace line: {}".format(decode(line)))
+
+            level.append(int(info[0]))
+            function_num.append(int(info[1]))
+            kind.append(record_kind)
+            value_start.append(len(heap_offsets) - 1)
+
+            if record_kind == KIND_RETURN:
+                time_index.append(-1)
+                memory.append(-1)
+                function_id.append(-1)
+                filename_id.append(-1)
+                line_number.append(-1)
+                user_defined.append(0)
+
+                heap += info[5]
+                heap_offsets.append(len(heap))
+                value_count.append(1)
+                continue
+
+            time_index.append(float(info[3]))
+            memory.append(int(info[4]))
+
+            if record_kind == KIND_EXIT:
+                function_id.append(-1)
+                filename_id.append(-1)
+                line_number.append(-1)
+                user_defined.append(0)
+                value_count.append(0)
+                continue
+
+            function_id.append(function_ids.setdefault(info[5], len(function_ids)))
+            filename_id.append(filename_ids.setdefault(info[8], len(filename_ids)))
+            line_number.append(int(info[9]))
+            user_defined.append(info[6] == b"1")
+
+            if len(info) > PARAMS_FIELD:
+                params = info[PARAMS_FIELD].split(b"\t")
+                for param in params:
+                    heap += param
+                    heap_offsets.append(len(heap))
+                value_count.append(len(params))
+            else:
+                value_count.append(0)
+
+        columns = {
+            'level': np.frombuffer(level, dtype=np.int64),
+            'function_num': np.frombuffer(function_num, dtype=np.int64),
+            'kind': np.frombuffer(kind, dtype=np.int8),
+            'time_index': np.frombuffer(time_index, dtype=np.float64),
+            'memory': np.frombuffer(memory, dtype=np.int64),
+            'function_id': np.frombuffer(function_id, dtype=np.int32),
+            'filename_id': np.frombuffer(filename_id, dtype=np.int32),
+            'line_number': np.frombuffer(line_number, dtype=np.int32),
+            'is_function_user_defined': np.frombuffer(user_defined, dtype=np.int8).astype(bool),
+            'value_start': np.frombuffer(value_start, dtype=np.int64),
+            'value_count': np.frombuffer(value_count, dtype=np.int32),
+        }
+
+        return cls(
+            columns,
+            [decode(name) for name in function_ids],
+            [decode(name) for name in filename_ids],
+            bytes(heap),
+            np.frombuffer(heap_offsets, dtype=np.int64),
+            trace.function_mappings
+        )
+
+    def string(self, n):
+        """Decodes string `n` from the heap"""
+        return decode(self.heap[self.heap_offsets[n]:self.heap_offsets[n + 1]])
+
+    def params(self, row):
+        """The typed parameters of the Entry at `row`"""
+        start = self.value_start[row]
+        return [infer_type(self.string(n)) for n in range(start, start + self.value_count[row])]
+
+    def return_value(self, row):
+        """The typed return value of the Return at `row`"""
+        return infer_type(self.string(self.value_start[row]))
+
+    def definition_filenames(self):
+        """Where each function in `function_names` is defined, ordered by function id"""
+        return [self.function_mappings.get(name, "{{missing file}}") for name in self.function_names]
+
+    def rows(self, kind):
+        """Row indices of all records of a given kind"""
+        return np.flatnonzero(self.kind == kind)
+
+    def join_calls(self):
+        """Matches every Entry to its Exit and Return row by function number
+
+        Returns the entry rows along with their exit and return rows, -1 where missing"""
+        entries = self.rows(KIND_ENTRY)
+        size = int(self.function_num.max()) + 1 if len(self) else 0
+
+        exit_rows = np.full(size, -1, dtype=np.int64)
+        exits = self.rows(KIND_EXIT)
+        exit_rows[self.function_num[exits]] = exits
+
+        return_rows = np.full(size, -1, dtype=np.int64)
+        returns = self.rows(KIND_RETURN)
+        return_rows[self.function_num[returns]] = returns
+
+        entry_nums = self.function_num[entries]
+        return entries, exit_rows[entry_nums], return_rows[entry_nums]
+
+    def call_deltas(self):
+        """Vectorized time and memory deltas of every call, ordered like `join_calls`
+
+        Calls that never exited get -1 as their end and delta"""
+        entries, exits, returns = self.join_calls()
+        exited = exits >= 0
+
+        time_end = np.where(exited, self.time_index[exits], -1)
+        memory_end = np.where(exited, self.memory[exits], -1)
+        time_delta = np.where(exited, time_end - self.time_index[entries], -1)
+        memory_delta = np.where(exited, memory_end - self.memory[entries], -1)
+
+        return entries, exits, returns, time_end, memory_end, time_delta, memory_delta
+
+    def function_aggregates(self):
+        """Per function invocation count, total time and total memory, indexed by function id
+
+        Calls that never exited are counted but add nothing to the totals"""
+        entries, exits, _, _, _, time_delta, memory_delta = self.call_deltas()
+        exited = exits >= 0
+        ids = self.function_id[entries]
+        size = len(self.function_names)
+
+        return {
+            'name': self.function_names,
+            'count': np.bincount(ids, minlength=size),
+            'time': np.bincount(ids[exited], weights=time_delta[exited], minlength=size),
+            'memory': np.bincount(ids[exited], weights=memory_delta[exited], minlength=size).astype(np.int64),
+        }
+
+
+def ordered_function_calls(table):
+    """Same result as PHPTraceParser.ordered_function_calls, computed on a TraceTable"""
+    entries, exits, returns, time_end, memory_end, time_delta, memory_delta = table.call_deltas()
+    exited = (exits >= 0).tolist()
+
+    definition_filenames = table.definition_filenames()
+    function_ids = table.function_id[entries].tolist()
+    filename_ids = table.filename_id[entries].tolist()
+    line_numbers = table.line_number[entries].tolist()
+    memory_start = table.memory[entries].tolist()
+    time_start = table.time_index[entries].tolist()
+    function_nums = table.function_num[entries].tolist()
+    memory_end, memory_delta = memory_end.tolist(), memory_delta.tolist()
+    time_end, time_delta = time_end.tolist(), time_delta.tolist()
+
+    calls = []
+    for i, row in enumerate(entries.tolist()):
+        return_row = returns[i]
+
+        calls.append({
+            'function_num': function_nums[i],
+            'name': table.function_names[function_ids[i]],
+            'parameters': table.params(row),
+            'calling_filename': table.filenames[filename_ids[i]],
+            'definition_filename': definition_filenames[function_ids[i]],
+            'line_number': str(line_numbers[i]),
+            'return': table.return_value(return_row) if return_row >= 0 else PHP_INST_VOID,
+            'memory_start': memory_start[i],
+            'memory_end': memory_end[i] if exited[i] else -1,
+            'memory_delta': memory_delta[i] if exited[i] else -1,
+            'time_start': time_start[i],
+            'time_end': time_end[i] if exited[i] else -1,
+            'time_delta': time_delta[i] if exited[i] else -1
+        })
+
+        if function_nums[i] == 0:
+            # main is recorded as a function call
+            calls[-1]['return'] = PHP_INST_VOID
+
+    return calls
+
+
+def call_tree(table):
+    """Same output as PHPTraceParser.call_tree"""
+    entries = table.rows(KIND_ENTRY)
+    stems = [Path(filename).stem for filename in table.filenames]
+
+    for row, level, filename_id, line_number, function_id in zip(
+            entries.tolist(),
+            table.level[entries].tolist(),
+            table.filename_id[entries].tolist(),
+            table.line_number[entries].tolist(),
+            table.function_id[entries].tolist()):
+        print(indent_level(level), row, "{0}:{1}@{2}".format(stems[filename_id], line_number, table.function_names[function_id]))
+
+
+def function_names(table):
+    """Same result as PHPTraceParser.function_names"""
+    definition_filenames = table.definition_filenames()
+    return {(name + "\t" + definition_filename, ) for name, definition_filename in zip(table.function_names, definition_filenames)}
+
+
+def filenames(table):
+    """Same result as PHPTraceParser.filenames, filename ids are handed out in order of appearance"""
+    return list(dict.fromkeys(table.filenames))
+
+
+def function_calls(table):
+    """Every call with its parameters and return value, in the order they were made"""
+    return [
+        {'name': call['name'], 'parameters': call['parameters'], 'return': call['return']}
+        for call in ordered_function_calls(table)
+    ]
+
+
+def grouped_function_calls(table):
+    """All calls grouped by the name of the called function"""
+    calls = {}
+
+    for call in ordered_function_calls(table):
+        calls.setdefault(call['name'], []).append(call)
+
+    return calls
@@ -11,19 +11,43 @@ xdebug.trace_format=1
 xdebug.collect_return=1
 xdebug.trace_output_name={set an appropriate directory}
 
+Traces written with xdebug's compression (.xt.gz) are read as they are.
+
 Find more info on these here: https://xdebug.org/docs/all_settings
 """
 
+import os
 from pathlib import Path
 from PHPLangUtils import infer_type
+import PHPTraceFiles
+
+READ_BUFFER_SIZE = 1024 * 1024
+"""Traces are read in large binary chunks, lines are only split and decoded where needed"""
+
+PARAMS_FIELD = 11
+"""Index of the first parameter of an Entry line, all further fields are parameters"""
+
+
+DISCRIMINATORS = {"Entry": b"0", "Exit": b"1", "Return": b"R"}
+"""The value of the third column for each kind of record"""
+
+RECORD_DISCRIMINATORS = set(DISCRIMINATORS.values())
+
 
 class Field:
+    __slots__ = ()
+
     @property
     def type(self):
         return type(self).__name__
 
 
 class Entry(Field):
+    __slots__ = (
+        'level', 'function_num', 'time_index', 'memory', 'function_name', 'is_function_user_defined',
+        '_include_filename', '_filename', '_line_number', '_raw_params', '_params', '_function_mappings'
+    )
+
     def __init__(self, fields, function_mappings):
         self.level = int(fields[0])
         """the stack-depth starting at 0"""
@@ -37,30 +61,57 @@ class Entry(Field):
         self.memory = int(fields[4])
         """Memory usage in bytes before starting this function"""
 
-        self.function_name = fields[5]
+        self.function_name = decode(fields[5])
         """The function's defined name, anonymous functions are {closure:PATH:linenums}"""
 
-        self.is_function_user_defined = fields[6] == "1"
+        self.is_function_user_defined = fields[6] == b"1"
         """Whether the function is part of std-lib, or defined in php
         Beware: Is true for functions defined in external libraries"""
 
-        self.include_filename = fields[7]
+        # everything below is kept raw until it is asked for
+        self._include_filename = fields[7]
+        self._filename = fields[8]
+        self._line_number = fields[9]
+        self._raw_params = fields[11] if len(fields) > PARAMS_FIELD else None
+        self._params = None
+        self._function_mappings = function_mappings
+
+    @property
+    def include_filename(self):
         """If the function is require/include, this field has the value of the path included/required"""
+        return decode(self._include_filename)
 
-        self.filename = fields[8]
+    @property
+    def filename(self):
         """Filename where the function got called"""
+        return decode(self._filename)
 
-        self.line_number = fields[9]
+    @property
+    def line_number(self):
         """Line number where the function definition starts"""
+        return decode(self._line_number)
+
+    @property
+    def params(self):
+        """All parameters of the function, typed on first access"""
+        if self._params is None:
+            if self._raw_params is None:
+                self._params = []
+            else:
+                self._params = [infer_type(decode(value)) for value in self._raw_params.split(b"\t")]
+            self._raw_params = None
 
-        self.params = [infer_type(value) for value in fields[11:]]
-        """All parameters of the function"""
+        return self._params
 
-        self.definition_filename = function_mappings.get(fields[5], "{{missing file}}")
+    @property
+    def definition_filename(self):
         """Where the called function is defined"""
+        return self._function_mappings.get(self.function_name, "{{missing file}}")
 
 
 class Exit(Field):
+    __slots__ = ('level', 'function_num', 'time_index', 'memory')
+
     def __init__(self, fields):
         self.level = int(fields[0])
         self.function_num = int(fields[1])
@@ -69,37 +120,150 @@ class Exit(Field):
 
 
 class Return(Field):
+    __slots__ = ('level', 'function_num', '_raw_return_value', '_return_value')
+
     def __init__(self, fields):
         self.level = int(fields[0])
         self.function_num = int(fields[1])
-        self.return_value = infer_type(fields[5])
+        self._raw_return_value = fields[5]
+        self._return_value = None
+
+    @property
+    def return_value(self):
+        """The typed return value, typed on first access"""
+        if self._return_value is None:
+            self._return_value = infer_type(decode(self._raw_return_value))
+            self._raw_return_value = None
+
+        return self._return_value
+
+
+def decode(field):
+    """Decodes a single raw field of a trace line, the trace is read as bytes
+    so only the fields that are actually used ever get decoded"""
+    return field.decode("utf-8", errors="ignore")
+
+
+def is_trace_metadata(line):
+    """Whether a raw line is part of the trace header or footer rather than a record"""
+    return line.startswith((b"Version: ", b"File format: ", b"TRACE START [", b"TRACE END")) or line == b"\n"
+
+
+def discriminator(line):
+    """The record kind column of a raw line, found without splitting the line"""
+    second_tab = line.find(b"\t", line.find(b"\t") + 1)
+    if second_tab < 0:
+        return None
+    return line[second_tab + 1:second_tab + 2]
+
+
+def parse_line(line, function_mappings):
+    """Tokenizes a single raw trace line into an Entry, Exit or Return
+
+    Returns None for lines that aren't records, such as the trace header"""
+    if line.endswith(b"\r\n"):
+        # the trace used to be read in text-mode, keep the universal newline behaviour
+        line = line[:-2] + b"\n"
+
+    # the parameters are left as a single raw tail, only split when they are used
+    info = line.split(b"\t", PARAMS_FIELD)
+    try:
+        discriminator = info[2]
+        if discriminator == b'0':
+            return Entry(info, function_mappings)
+        elif discriminator == b'1':
+            return Exit(info)
+        elif discriminator == b'R':
+            return Return(info)
+    except Exception as e:
+        # pass
+        if is_trace_metadata(line):
+            return None
+        print(decode(line))
+        print("parsing error")
+        raise e
+        # missed node.. parsing error
+
+    return None
+
 
 class Trace:
     def __init__(self, path, function_mappings):
         self.path = path
         self.function_mappings = function_mappings
 
-    def visit(self, filterfn):
-        for i, field in enumerate(self.parse()):
+    def visit(self, filterfn, kinds=None):
+        for field, i in self.records(kinds=kinds):
             if filterfn(field):
                 yield (field, i)
 
-    def parse(self):
-        for line in open(self.path, encoding="utf-8", errors="ignore"):
-            info = line.split("\t")
-            try:
-                discriminator = info[2]
-                if discriminator == '0':
-                    yield Entry(info, self.function_mappings)
-                elif discriminator == '1':
-                    yield Exit(info)
-                elif discriminator == 'R':
-                    yield Return(info)
-            except Exception as e:
-                # pass
-                if 'Version: ' in line or 'File format: ' in line or 'TRACE START [' in line or 'TRACE END' in line or '\n' == line:
+    def raw_lines(self, start=0, end=None):
+        """Yields the undecoded lines of the trace file
+
+        Optionally only the lines starting within the byte range [start, end)"""
+        with PHPTraceFiles.open_binary(self.path, READ_BUFFER_SIZE) as f:
+            if start:
+                f.seek(start)
+
+            if end is None:
+                yield from f
+                return
+
+            position = start
+            for line in f:
+                if position >= end:
+                    break
+                yield line
+                position += len(line)
+
+    def records(self, start=0, end=None, kinds=None):
+        """Yields every record along with its index in the trace
+
+        `kinds` optionally limits the records to a set of type names such as {"Entry"},
+        lines of other kinds are skipped before anything gets split or constructed.
+        Skipped records still count towards the index."""
+        wanted = None
+        if kinds is not None:
+            wanted = {DISCRIMINATORS[kind] for kind in kinds}
+
+        i = 0
+        for line in self.raw_lines(start, end):
+            if wanted is not None:
+                kind = discriminator(line)
+                if kind in RECORD_DISCRIMINATORS and kind not in wanted:
+                    i += 1
                     continue
-                print(line)
-                print("parsing error")
-                raise e
-                # missed node.. parsing error
+
+            field = parse_line(line, self.function_mappings)
+            if field is not None:
+                yield (field, i)
+                i += 1
+
+    def parse(self, start=0, end=None, kinds=None):
+        for field, i in self.records(start, end, kinds):
+            yield field
+
+    def split(self, count):
+        """Divides the trace file in at most `count` byte ranges of roughly equal size
+        that each start at the beginning of a line
+
+        Compressed traces can't be split, they come back as a single range"""
+        if PHPTraceFiles.is_compressed(self.path):
+            return [(0, None)]
+
+        size = os.path.getsize(self.path)
+        boundaries = [0]
+
+        with open(self.path, "rb") as f:
+            for i in range(1, count):
+                f.seek(max(size * i // count, boundaries[-1]))
+                # move on to the start of the next line
+                f.readline()
+                boundary = f.tell()
+                if boundary >= size:
+                    break
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+
+        boundaries.append(size)
+        return list(zip(boundaries, boundaries[1:]))
@@ -16,19 +16,30 @@ import re
 import time
 import sys
 import traceback
+import threading
+import queue
+import multiprocessing
 import datetime
-import uuid
-from contextlib import contextmanager
+import hashlib
+from contextlib import closing, contextmanager
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from timeit import default_timer
-from collections import Counter
+from collections import Counter, namedtuple
 from pprint import pprint
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-from PHPLangUtils import PHP_TYPE_INTEGER, PHP_TYPE_DOUBLE, php_typed_value
+from PHPLangUtils import PHP_TYPE_INTEGER, PHP_TYPE_DOUBLE
 import PHPTraceParser
 import PHPTraceTokenizer
 import PHPProfileParser
+import PHPTraceFiles
+import storageProfiles
+import valueCompression
+import shardedDatabase
+import traceWatcher
+import settings
 from settings import traceDir
 
 logging.getLogger('apscheduler').setLevel(logging.CRITICAL)
@@ -36,6 +47,64 @@ logging.getLogger('apscheduler').setLevel(logging.CRITICAL)
 
 SCHEMA_PATH = "schema.sql"
 
+SCHEMA_VERSION = 3
+"""Stored as the `user_version` of the database, see `migrate_db`"""
+
+INTEGER_INVOCATION_KEYS_MIGRATION = """
+BEGIN;
+
+CREATE TABLE `function_invocations_v2`
+(
+    `id` INTEGER PRIMARY KEY,
+    `name` INTEGER,
+    `returnval` INTEGER,
+    `calling_filename` INTEGER,
+    `definition_filename` INTEGER,
+    `linenum` INTEGER,
+    `memory` INTEGER,
+    `time` INTEGER,
+    `requestname` TEXT,
+
+    FOREIGN KEY(`name`) REFERENCES `function_names`(`ROWID`),
+    FOREIGN KEY(`calling_filename`) REFERENCES `file_names`(`ROWID`),
+    FOREIGN KEY(`definition_filename`) REFERENCES `file_names`(`ROWID`),
+    FOREIGN KEY(`returnval`) REFERENCES `values`(`ROWID`),
+    FOREIGN KEY(`memory`) REFERENCES `values`(`ROWID`),
+    FOREIGN KEY(`time`) REFERENCES `values`(`ROWID`),
+    FOREIGN KEY(`requestname`) REFERENCES `traces`(`requestname`)
+);
+INSERT INTO `function_invocations_v2`
+SELECT `rowid`, `name`, `returnval`, `calling_filename`, `definition_filename`, `linenum`, `memory`, `time`, `requestname`
+FROM `function_invocations`
+ORDER BY `rowid`;
+
+-- parameters were inserted in order, and old databases stored some hashes with INTEGER affinity
+CREATE TABLE `invocation_parameters_v2`
+(
+    `invocation_id` INTEGER,
+    `position` INTEGER,
+    `value_id` INTEGER,
+
+    PRIMARY KEY(`invocation_id`, `position`),
+    FOREIGN KEY(`invocation_id`) REFERENCES `function_invocations_v2`(`id`),
+    FOREIGN KEY(`value_id`) REFERENCES `values`(`ROWID`)
+) WITHOUT ROWID;
+INSERT INTO `invocation_parameters_v2`
+SELECT
+    `f`.`rowid`,
+    row_number() OVER (PARTITION BY `f`.`rowid` ORDER BY `p`.`rowid`) - 1,
+    `p`.`value_id`
+FROM `function_invocations` `f`
+    JOIN `invocation_parameters` `p` ON `p`.`function_invocation_hash` = CAST(`f`.`hash` AS TEXT);
+
+DROP TABLE `invocation_parameters`;
+DROP TABLE `function_invocations`;
+ALTER TABLE `function_invocations_v2` RENAME TO `function_invocations`;
+ALTER TABLE `invocation_parameters_v2` RENAME TO `invocation_parameters`;
+
+COMMIT;
+"""
+
 @contextmanager
 def elapsed_timer():
     """https://stackoverflow.com/a/30024601"""
@@ -52,17 +121,63 @@ parser.add_argument('-a', '--auto-import', action="store_true", dest="autoImport
 parser.add_argument('-r', '--auto-remove', action="store_true", dest="autoRemove", default=False, help="Remove traces after succesfully processing")
 parser.add_argument('-n', '--no-db', action="store_true", dest='nodb', default=False, help="Don't write anything to the database. Useful during debugging.")
 parser.add_argument('-w', '--watch', action="store_true", dest="watch", default=False, help="Automatically import any newly created requests.")
+parser.add_argument('-t', '--tail', action="store_true", dest="tail", default=False, help="Already import the finished calls of requests that are still running")
+parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=1, help="Number of processes used to tokenize a single trace")
+parser.add_argument('-s', '--shard-dir', nargs="?", dest="shard_dir", type=str, default=getattr(settings, 'shard_dir', None), help="Write every request to the database of the day it ran on in this directory, instead of to --db")
+parser.add_argument('-p', '--processes', dest="processes", type=int, default=1, help="Number of requests that are prepared at the same time while importing")
 
 
 def open_db_connection(db_name):
-    conn = sqlite3.connect(db_name)
-    conn.execute("PRAGMA synchronous = OFF")
+    return storageProfiles.connect(db_name, 'ingest')
+
+def open_shard(db_name):
+    conn = open_db_connection(db_name)
+    set_up_db(conn)
     return conn
 
+@contextmanager
+def request_transaction(conn, mapping_store=None):
+    """Everything written for a request is committed at once, or not at all
+
+    On a rollback `mapping_store` forgets what was merged into it in the meantime as well"""
+    saved = mapping_store.save() if mapping_store is not None else None
+    if not conn.in_transaction:
+        # the ids InternTable looks up have to stay until they're referred to, see retention.collect_garbage
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        if mapping_store is not None:
+            mapping_store.restore(saved)
+        raise
+
+    if conn.in_transaction:
+        with elapsed_timer() as commit_timer:
+            conn.commit()
+        print("Took {:.4f}s to commit to db".format(commit_timer()))
+
+REQUEST_FILENAME = re.compile(
+    r"(?P<seconds>\d+)_(?P<microseconds>\d+) (?P<uid>[a-zA-Z0-9@\-]+)(?P<ext>\.x[pt])(?P<compression>{})?$".format(
+        "|".join(re.escape(suffix) for suffix in PHPTraceFiles.COMPRESSED_OPENERS)
+    )
+)
+"""`xdebug.trace_output_name="%u %U"`, see the readme"""
+
+TAIL_INTERVAL = 1
+"""Seconds in between the polls of requests that are still running, or whose files aren't released yet"""
+
+PREPARED_BATCHES = 4
+"""CallBatches of a request a worker of `import_requests` can be ahead of the writer"""
+
+TAIL_ID_SPACE = 2 ** 32
+"""Invocation ids kept free for the calls of a trace that's being tailed, see `reserve_invocation_ids`"""
+
 def parse_request_filename(filename):
     """Takes a filename of a file in the traces directory
     and returns the timestamp, whether it's a profile or trace file,
     and a unique id for that specific request.
+    Traces and profiles may be compressed (`.xt.gz`, `.xp.gz`, ...)
 
     Returns False on failure"""
 
@@ -70,12 +185,11 @@ def parse_request_filename(filename):
         'type': None,
         'timestamp': None,
         'request_id': None,
-        'filename': filename
+        'filename': filename,
+        'compressed': False
     }
 
-    fmt = re.compile(r"(?P<seconds>\d+)_(?P<microseconds>\d+) (?P<uid>[a-zA-Z0-9@\-]+)(?P<ext>\.x[pt])")
-
-    match = fmt.match(filename)
+    match = REQUEST_FILENAME.match(filename)
 
     if match:
         ext = match.group('ext')
@@ -91,16 +205,52 @@ def parse_request_filename(filename):
         info['timestamp'] = datetime.datetime.fromtimestamp(t)
 
         info['request_id'] = match.group('uid')
+        info['compressed'] = match.group('compression') is not None
 
         return info
 
     return False
 
+def value_hash(value):
+    """The 64-bit hash `values` are deduplicated on"""
+    if value is None:
+        return None
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def migrate_db(conn):
+    """Brings a database created by an older version up to SCHEMA_VERSION"""
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    tables = {name for name, in c.execute("SELECT `name` FROM `sqlite_master` WHERE `type`='table'")}
+
+    if 'values' in tables and version < 1:
+        print("Migrating database: hashing `values`, this can take a while")
+        conn.create_function("value_hash", 1, value_hash, deterministic=True)
+        c.execute("ALTER TABLE `values` ADD COLUMN `hash` INTEGER")
+        c.execute("UPDATE `values` SET `hash`=value_hash(`value`)")
+        c.execute("DROP INDEX IF EXISTS `idx_values`")
+        conn.commit()
+        print("The space of the old index is only given back to the OS after a VACUUM")
+
+    if 'function_invocations' in tables and version < 2:
+        print("Migrating database: replacing invocation hashes with integer keys, this can take a while")
+        # the indexes are added by the schema
+        c.executescript(INTEGER_INVOCATION_KEYS_MIGRATION)
+
+    if 'values' in tables and version < 3:
+        # existing values stay as they are, see valueCompression.py to compress them
+        c.execute("ALTER TABLE `values` ADD COLUMN `compression` INTEGER")
+        conn.commit()
+
 def set_up_db(conn):
+    migrate_db(conn)
+
     c = conn.cursor()
     with open(SCHEMA_PATH) as f:
         c.executescript(f.read())
-        conn.commit()
+    c.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+    conn.commit()
 
 def request_exists(request, conn):
     c = conn.cursor()
@@ -112,96 +262,368 @@ def get_all_types(conn):
     c.execute("SELECT php_type, rowid FROM `value_types`")
     return {key: value for key, value in c.fetchall()}
 
+class FunctionMappingStore:
+    """function name > definition file, persisted in `function_definitions`
+
+    Profiles are only parsed once a trace calls a function that no earlier profile defined,
+    their definitions are then merged into the store.
+    Without a connection the store starts from `mapping` and only collects what's merged into it"""
+
+    def __init__(self, conn, mapping=None):
+        self.conn = conn
+        self.merged = {}
+        """Everything merged since the store was created"""
+
+        if mapping is None:
+            c = conn.cursor()
+            c.execute("SELECT `function_name`, `file_name` FROM `function_definitions`")
+            mapping = c.fetchall()
+        self.mapping = dict(mapping)
+
+    def merge_profiles(self, profile_filenames):
+        with elapsed_timer() as profiler_timer:
+            function_mappings = PHPProfileParser.get_function_file_mapping(profile_filenames)
+        print("Took {:.4f} seconds to parse profile".format(profiler_timer()))
+
+        self.merge(function_mappings)
+
+    def merge(self, function_mappings):
+        """Adds definitions, replacing the ones that changed"""
+        changed = [(name, file) for name, file in function_mappings.items() if self.mapping.get(name) != file]
+        self.mapping.update(changed)
+        self.merged.update(changed)
+        if self.conn is None:
+            return
+
+        c = self.conn.cursor()
+        c.executemany("INSERT OR REPLACE INTO `function_definitions` (`function_name`, `file_name`) VALUES (?, ?)", changed)
+
+    def for_request(self, profile_filenames=()):
+        return RequestFunctionMapping(self, profile_filenames)
+
+    def save(self):
+        return dict(self.mapping), dict(self.merged)
+
+    def restore(self, saved):
+        """Back to what `save` returned, for when what was merged since wasn't committed"""
+        mapping, merged = saved
+        self.mapping, self.merged = dict(mapping), dict(merged)
+
+
+class RequestFunctionMapping:
+    """The function_mappings of the traces of one request, backed by a FunctionMappingStore"""
+
+    def __init__(self, store, profile_filenames=()):
+        self.store = store
+        self.profile_filenames = list(profile_filenames)
+        self.parsed = False
+
+    def add_profiles(self, profile_filenames):
+        """Profiles of a request that was tailed only exist once it's done"""
+        self.profile_filenames.extend(profile_filenames)
+        self.parsed = False
+
+    def parse_profiles(self):
+        if not self.parsed and self.profile_filenames:
+            self.store.merge_profiles(self.profile_filenames)
+        self.parsed = True
+
+    def get(self, function_name, default=None):
+        if function_name not in self.store.mapping:
+            self.parse_profiles()
+        return self.store.mapping.get(function_name, default)
+
+    def resolved(self):
+        """A plain dict with everything the profiles define, for use in other processes"""
+        self.parse_profiles()
+        return dict(self.store.mapping)
+
 def insert_request(uid, conn):
     c = conn.cursor()
+    # its tails are done, whatever ids they didn't use are free again
+    c.execute("DELETE FROM `invocation_id_reservations` WHERE `requestname`=:requestname", {'requestname': uid})
     timestamp = datetime.datetime.today().isoformat()
     c.execute("INSERT INTO `traces` (`requestname`, `timestamp`) VALUES (:requestname, :timestamp);", {'requestname': uid, 'timestamp': timestamp})
-    conn.commit()
 
-def insert_trace(trace, uid, conn):
-    with elapsed_timer() as traceParseTimer:
-        calls = PHPTraceParser.ordered_function_calls(trace)
-    print("Took {:.4f}s to parse traces".format(traceParseTimer()))
+def parse_trace(trace, jobs=1):
+    """All calls of a trace, see `insert_calls`
+
+    Calls are read as they're needed, unless the trace is tokenized in parallel.
+    Calls that finish before the definition of their function is learned (see
+    PHPTraceParser.TraceDefinitions) are left for `repair_definition_filenames`"""
+    if jobs > 1 and not isinstance(trace.function_mappings, PHPTraceParser.TraceDefinitions):
+        with elapsed_timer() as traceParseTimer:
+            calls = PHPTraceParser.parallel_ordered_function_calls(trace, jobs)
+        print("Took {:.4f}s to parse traces".format(traceParseTimer()))
+        return calls
+
+    return PHPTraceParser.iter_ordered_function_calls(trace)
+
+def insert_trace(trace, uid, conn, jobs=1):
+    insert_calls(parse_trace(trace, jobs), uid, conn)
+    repair_definition_filenames(uid, trace.function_mappings, conn)
+
+LOOKUP_BATCH_SIZE = 500
+"""SQLite versions before 3.32 allow at most 999 parameters per statement"""
+
+INSERT_BATCH_SIZE = 20000
+"""Calls per CallBatch, the memory an import takes depends on this instead of on the size of the trace"""
+
+def batches(items, size=LOOKUP_BATCH_SIZE):
+    """Lists of `size` items, `items` is only consumed as far as needed"""
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+def stored_text(conn, numbers):
+    """number > the text SQLite stores for it in a TEXT column
+
+    Reals aren't converted like Python's str does (0.1 + 0.2 is stored as '0.3'),
+    so the conversion is left to SQLite"""
+    texts = {}
+    c = conn.cursor()
+    for batch in batches({number for number in numbers if isinstance(number, float)}):
+        c.execute(
+            "SELECT `column1`, CAST(`column1` AS TEXT) FROM (VALUES {})".format(", ".join(["(?)"] * len(batch))),
+            batch
+        )
+        texts.update(c.fetchall())
+    for number in numbers:
+        if not isinstance(number, float):
+            texts[number] = str(number)
+    return texts
+
+class InternTable:
+    """text > rowid of one of the lookup tables (`values`, `file_names`, `function_names`)
+
+    The ids of a whole batch are looked up at once and the missing rows are
+    inserted with explicit rowids, so the rows referring to them can be
+    inserted with plain integers instead of a subquery per reference.
+    Tables with a `hash` column (`values`) are looked up by hash, and the texts compared here.
+    With a `compressor` (valueCompression.ValueCompressor) texts are stored through it"""
+
+    def __init__(self, conn, table, column, other_columns=(), hashed=False, compressor=None):
+        self.conn = conn
+        self.table = table
+        self.column = column
+        self.other_columns = other_columns
+        self.hashed = hashed
+        self.compressor = compressor
+        self.ids = {}
+
+    def __getitem__(self, key):
+        return self.ids[key]
+
+    def intern(self, rows):
+        """Gives every key of `rows` an id, `rows` maps keys to the values of `other_columns`
+
+        Returns the number of rows that were inserted"""
+        c = self.conn.cursor()
+
+        missing = [key for key in rows if key not in self.ids]
+        hashes = {key: value_hash(key) for key in missing} if self.hashed else {}
+        lookup_column = "hash" if self.hashed else self.column
+
+        selected = "`{}`, `compression`".format(self.column) if self.compressor else "`{}`".format(self.column)
+        for batch in batches(missing):
+            c.execute(
+                "SELECT {selected}, `rowid` FROM `{table}` WHERE `{lookup_column}` IN ({keys})".format(
+                    selected=selected, table=self.table, lookup_column=lookup_column, keys=", ".join(["?"] * len(batch))
+                ),
+                [hashes[key] for key in batch] if self.hashed else batch
+            )
+            found = c.fetchall()
+            if self.compressor:
+                found = [(self.compressor.decompress(value, compression), rowid) for value, compression, rowid in found]
+            # a hash can also match other values
+            self.ids.update((key, rowid) for key, rowid in found if key in rows)
+
+        missing = [key for key in missing if key not in self.ids]
+        if not missing:
+            keep_from_garbage_collection(self.conn, self.table, (self.ids[key] for key in rows))
+            return 0
+
+        c.execute("SELECT IFNULL(MAX(`rowid`), 0) FROM `{}`".format(self.table))
+        next_id = c.fetchone()[0] + 1
+        for rowid, key in enumerate(missing, next_id):
+            self.ids[key] = rowid
+
+        stored = {key: (key, ) for key in missing}
+        if self.compressor:
+            self.compressor.train(missing)
+            stored = {key: self.compressor.compress(key) for key in missing}
+
+        columns = ("rowid", self.column) + (("compression", ) if self.compressor else ()) + (("hash", ) if self.hashed else ()) + tuple(self.other_columns)
+        c.executemany(
+            "INSERT INTO `{table}` ({columns}) VALUES ({placeholders})".format(
+                table=self.table,
+                columns=", ".join("`{}`".format(column) for column in columns),
+                placeholders=", ".join(["?"] * len(columns))
+            ),
+            ((self.ids[key], ) + stored[key] + ((hashes[key], ) if self.hashed else ()) + tuple(rows[key]) for key in missing)
+        )
+        keep_from_garbage_collection(self.conn, self.table, (self.ids[key] for key in rows))
+        return len(missing)
+
+def keep_from_garbage_collection(conn, table, ids):
+    """Tells retention.collect_garbage, when it's collecting `table`, that `ids` are in use
+
+    It only knows what was referred to when it started, and removes the rest a batch at a time"""
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM `garbage_collection` WHERE `table_name`=? AND `id`=0", (table, ))
+    if c.fetchone():
+        c.executemany("INSERT OR IGNORE INTO `garbage_collection` VALUES (?, ?)", ((table, rowid) for rowid in ids))
+
+CallBatch = namedtuple('CallBatch', ['values', 'file_names', 'function_names', 'invocations', 'parameters'])
+"""Calls in the shape of the database rows, with texts in place of the ids, see `prepare_calls`"""
+
+def prepare_calls(calls):
+    """Everything insert_calls does that doesn't need the database, so it can happen in another process"""
+    values = {}
+    """value > (php type, ), the first type a value is seen with is kept"""
+    file_names = {}
+    function_names = {}
+    invocations = []
+    parameters = []
+    memory_deltas = set()
+    time_deltas = set()
+    calls = list(calls)
 
-    values = set()
-    file_names = set()
-    function_names = set()
-    function_invocations = []
-    params = []
     for call in calls:
-        name = call['name']
-        h = str(uuid.uuid4())
+        for param in call['parameters']:
+            values.setdefault(param.value, (param.php_type, ))
+
         retval = call['return']
-        definition_filename = call['definition_filename']
-        calling_filename = call['calling_filename']
-        memory_delta = call['memory_delta']
-        time_delta = call['time_delta']
+        values.setdefault(retval.value, (retval.php_type, ))
 
-        for param in call['parameters']:
-            values.add(param)
-            params.append({
-                "function_invocation_hash": h,
-                "value": param.value
-            })
-
-        values.add(retval)
-        values.add(php_typed_value(php_type=PHP_TYPE_INTEGER, value=memory_delta))
-        values.add(php_typed_value(php_type=PHP_TYPE_DOUBLE, value=time_delta))
-
-        file_names.add((definition_filename,))
-        file_names.add((calling_filename,))
-
-        function_names.add((name,))
-
-        function_invocations.append({
-            "name": name,
-            "returnval": retval.value,
-            "calling_filename": calling_filename,
-            "definition_filename": definition_filename,
-            "linenum": call['line_number'],
-            "hash": h,
-            "time": time_delta,
-            "memory": memory_delta,
-            "requestname": uid
-        })
+        memory_deltas.add(call['memory_delta'])
+        time_deltas.add(call['time_delta'])
+
+        file_names[call['definition_filename']] = ()
+        file_names[call['calling_filename']] = ()
+        function_names[call['name']] = ()
+
+    # any connection stores numbers the same way
+    conn = sqlite3.connect(":memory:")
+    memory_deltas = stored_text(conn, memory_deltas)
+    time_deltas = stored_text(conn, time_deltas)
+    conn.close()
+
+    for text in memory_deltas.values():
+        values.setdefault(text, (PHP_TYPE_INTEGER, ))
+    for text in time_deltas.values():
+        values.setdefault(text, (PHP_TYPE_DOUBLE, ))
 
+    for call in calls:
+        invocations.append((
+            call['name'],
+            call['return'].value,
+            call['calling_filename'],
+            call['definition_filename'],
+            memory_deltas[call['memory_delta']],
+            time_deltas[call['time_delta']],
+            call['line_number'],
+            call['function_num']
+        ))
+        parameters.append([param.value for param in call['parameters']])
+
+    return CallBatch(values, file_names, function_names, invocations, parameters)
+
+def first_invocation_id(conn):
+    """The id the calls of a trace are numbered from, see `write_calls`
+
+    Past the ids reserved for the traces that are being tailed, their calls that
+    are still running are numbered when they complete"""
+    c = conn.cursor()
+    c.execute("""
+        SELECT MAX(
+            (SELECT IFNULL(MAX(`id`), 0) FROM `function_invocations`),
+            (SELECT IFNULL(MAX(`reserved_until`), 0) FROM `invocation_id_reservations`)
+        )
+    """)
+    return c.fetchone()[0] + 1
+
+def reserve_invocation_ids(uid, conn):
+    """`first_invocation_id` for a trace that's going to be tailed, with the TAIL_ID_SPACE ids after it kept free
+
+    The reservation is stored as soon as the tail starts, so every trace written
+    after it (in this run or by another process) is numbered past it.
+    It's released by `insert_request` or `remove_partial_request`"""
+    first_id = first_invocation_id(conn)
+    conn.execute(
+        "INSERT INTO `invocation_id_reservations` (`requestname`, `first_id`, `reserved_until`) VALUES (?, ?, ?)",
+        (uid, first_id, first_id + TAIL_ID_SPACE - 1)
+    )
+    return first_id
 
+def insert_calls(calls, uid, conn, first_id=None):
+    """Writes the calls of a trace in batches of INSERT_BATCH_SIZE as they come, `calls` can be a generator
+
+    Returns the id the calls are numbered from, pass it on to write more calls of the same trace"""
+    if first_id is None:
+        first_id = first_invocation_id(conn)
+    for chunk in batches(calls, INSERT_BATCH_SIZE):
+        write_calls(prepare_calls(chunk), uid, conn, first_id)
+    return first_id
+
+def write_calls(batch, uid, conn, first_id):
+    """Writes a CallBatch of a trace whose calls are numbered from `first_id`
+
+    Every invocation gets `first_id` + the number xdebug gave the call, so the
+    invocations of a trace are in the order they were entered, whatever order they're written in"""
     types = get_all_types(conn)
-    values = [{'value': value.value, 'php_type': types[value.php_type]} for value in values]
 
     with elapsed_timer() as db_timer:
         c = conn.cursor()
-        c.executemany(
-            """INSERT OR IGNORE INTO `values` (`value`, `php_type`) VALUES (:value, :php_type)""",
-            values
-        )
+
+        value_ids = InternTable(conn, "values", "value", ("php_type", ), hashed=True, compressor=valueCompression.ValueCompressor(conn))
+        inserted = value_ids.intern({value: (types[php_type], ) for value, (php_type, ) in batch.values.items()})
 
         prev_time = 0
         new_time = db_timer()
-        print("Took {:.4f}s to insert {} `values`".format(new_time - prev_time, len(values)))
+        print("Took {:.4f}s to insert {} of {} `values`".format(new_time - prev_time, inserted, len(batch.values)))
         prev_time = new_time
 
-        c.executemany(
-            """INSERT OR IGNORE into `file_names` VALUES (:file_name)""",
-            file_names
-        )
+        file_name_ids = InternTable(conn, "file_names", "name")
+        inserted = file_name_ids.intern(batch.file_names)
         new_time = db_timer()
-        print("Took {:.4f}s to insert {} `file_names`".format(new_time - prev_time, len(file_names)))
+        print("Took {:.4f}s to insert {} of {} `file_names`".format(new_time - prev_time, inserted, len(batch.file_names)))
         prev_time = new_time
 
-        c.executemany(
-            """INSERT OR IGNORE into `function_names` VALUES (:function_name)""",
-            function_names
-        )
+        function_name_ids = InternTable(conn, "function_names", "name")
+        inserted = function_name_ids.intern(batch.function_names)
         new_time = db_timer()
-        print("Took {:.4f}s to insert {} `function_names`".format(new_time - prev_time, len(function_names)))
+        print("Took {:.4f}s to insert {} of {} `function_names`".format(new_time - prev_time, inserted, len(batch.function_names)))
         prev_time = new_time
 
+        function_invocations = []
+        params = []
+        for invocation, parameters in zip(batch.invocations, batch.parameters):
+            name, returnval, calling_filename, definition_filename, memory, time, linenum, function_num = invocation
+            invocation_id = first_id + function_num
+            function_invocations.append((
+                invocation_id,
+                function_name_ids[name],
+                value_ids[returnval],
+                file_name_ids[calling_filename],
+                file_name_ids[definition_filename],
+                value_ids[memory],
+                value_ids[time],
+                linenum,
+                uid
+            ))
+
+            for position, value in enumerate(parameters):
+                params.append((invocation_id, position, value_ids[value]))
+
         c.executemany(
             """
             INSERT INTO
                 `function_invocations`
                 (
+                 `id`,
                  `name`,
                  `returnval`,
                  `calling_filename`,
@@ -209,21 +631,9 @@ def insert_trace(trace, uid, conn):
                  `memory`,
                  `time`,
                  `linenum`,
-                 `hash`,
                  `requestname`
                 )
-            VALUES
-                (
-                 (SELECT `rowid` FROM `function_names` WHERE `name`=:name),
-                 (SELECT `rowid` FROM `values` WHERE `value`=:returnval),
-                 (SELECT `rowid` FROM `file_names` WHERE `name`=:calling_filename),
-                 (SELECT `rowid` FROM `file_names` WHERE `name`=:definition_filename),
-                 (SELECT `rowid` FROM `values` WHERE `value`=:memory),
-                 (SELECT `rowid` FROM `values` WHERE `value`=:time),
-                 :linenum,
-                 :hash,
-                 :requestname
-                );
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             function_invocations
         )
@@ -231,24 +641,11 @@ def insert_trace(trace, uid, conn):
         print("Took {:.4f}s to insert {} `function_invocations`".format(new_time - prev_time, len(function_invocations)))
         prev_time = new_time
 
-        c.executemany(
-            """
-            INSERT INTO `invocation_parameters` VALUES
-            (
-                :function_invocation_hash,
-                (SELECT `rowid` FROM `values` WHERE `value`=:value)
-            )
-            """,
-            params)
+        c.executemany("INSERT INTO `invocation_parameters` (`invocation_id`, `position`, `value_id`) VALUES (?, ?, ?)", params)
         new_time = db_timer()
         print("Took {:.4f}s to insert {} `invocation_parameters`".format(new_time - prev_time, len(params)))
         prev_time = new_time
 
-        conn.commit()
-        new_time = db_timer()
-        print("Took {:.4f}s to commit to db".format(new_time - prev_time))
-        prev_time = new_time
-
 
 def trace_and_profile_from_request(traceDir, request):
     return (
@@ -268,7 +665,7 @@ def remove_request_files(request):
             # doesn't matter if it can't be cleaned now
             # will be cleaned on next removal run
             pass
-    for trace in request['profile']:
+    for trace in request.get('profile', []):
         try:
             os.unlink(trace['path'])
         except PermissionError:
@@ -277,25 +674,139 @@ def remove_request_files(request):
             # will be cleaned on next removal run
             pass
 
-def insert_request_in_db(conn, requests, uid, autoRemove=False):
+def remove_partial_request(uid, conn):
+    """Removes the invocations of a request that was never finished,
+    such as one that was being tailed when the program stopped"""
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM `invocation_parameters` WHERE `invocation_id` IN
+            (SELECT `id` FROM `function_invocations` WHERE `requestname`=:requestname)
+    """, {'requestname': uid})
+    c.execute("DELETE FROM `function_invocations` WHERE `requestname`=:requestname", {'requestname': uid})
+    c.execute("DELETE FROM `invocation_id_reservations` WHERE `requestname`=:requestname", {'requestname': uid})
+
+def repair_definition_filenames(uid, function_mappings, conn):
+    """Calls that were written before their definition was known (the profile of a request
+    that was being tailed, or what was learned further on in a trace), fill in their definition files now"""
+    c = conn.cursor()
+    c.execute("""
+        SELECT DISTINCT `fn`.`name`
+        FROM `function_invocations` `f`
+            JOIN `function_names` `fn` ON `f`.`name` = `fn`.`rowid`
+        WHERE `f`.`requestname`=:requestname
+          AND `f`.`definition_filename`=(SELECT `rowid` FROM `file_names` WHERE `name`=:missing)
+    """, {'requestname': uid, 'missing': "{{missing file}}"})
+
+    repairs = [
+        {'requestname': uid, 'function_name': name, 'file_name': file_name, 'missing': "{{missing file}}"}
+        for name, file_name in ((name, function_mappings.get(name)) for name, in c.fetchall())
+        if file_name is not None
+    ]
+
+    InternTable(conn, "file_names", "name").intern({repair['file_name']: () for repair in repairs})
+    c.executemany("""
+        UPDATE `function_invocations`
+        SET `definition_filename`=(SELECT `rowid` FROM `file_names` WHERE `name`=:file_name)
+        WHERE `requestname`=:requestname
+          AND `name`=(SELECT `rowid` FROM `function_names` WHERE `name`=:function_name)
+          AND `definition_filename`=(SELECT `rowid` FROM `file_names` WHERE `name`=:missing)
+    """, repairs)
+
+tails = {}
+"""request id > trace path > (PHPTraceParser.TraceTail, first invocation id), for requests whose traces are still being written"""
+
+def tail_request(conn, files, uid, mapping_store):
+    """Ingests the calls that completed since the last run in the traces of a running request"""
+    try:
+        with request_transaction(conn, mapping_store):
+            if uid not in tails:
+                remove_partial_request(uid, conn)
+                tails[uid] = {}
+
+            for trace in files.get('trace', []):
+                if trace['compressed']:
+                    continue
+
+                tail, first_id = tails[uid].get(trace['path'], (None, None))
+                if tail is None:
+                    # the profile is only complete once the request is, see `insert_request_in_db`
+                    function_mappings = PHPTraceParser.TraceDefinitions(mapping_store.for_request())
+                    tail = PHPTraceParser.TraceTail(create_trace(trace['path'], function_mappings))
+                    first_id = reserve_invocation_ids(uid, conn)
+                    tails[uid][trace['path']] = (tail, first_id)
+
+                calls = list(tail.poll())
+                if calls:
+                    insert_calls(calls, uid, conn, first_id)
+                    print("Flushed {} calls of running request --{}--".format(len(calls), uid))
+    except BaseException:
+        # the tails are past calls that weren't stored, so the next run starts over:
+        # it removes what earlier runs did store and reads the traces from the beginning
+        tails.pop(uid, None)
+        raise
+
+def request_profile_filenames(request):
+    # without a profile the definitions are learned from the trace, see PHPTraceParser.TraceDefinitions
+    return [os.path.join(traceDir, profile['filename']) for profile in request.get('profile', [])]
+
+def request_function_mappings(profile_filenames, mapping_store, jobs=1):
+    """The function_mappings of the traces of a request, and whether they can be tokenized in parallel"""
+    # profiles are only parsed when the trace calls a function the store doesn't know yet
+    function_mappings = mapping_store.for_request(profile_filenames)
+    if jobs > 1 and profile_filenames:
+        # worker processes can't reach the database, nor learn from other chunks
+        return function_mappings.resolved(), True
+    return function_mappings, False
+
+def trace_definitions(function_mappings, parallel=False):
+    """The function_mappings a trace is tokenized with
+
+    Unless it's tokenized in parallel, what the profiles don't define is learned
+    from the trace. Those are guesses, they're only used for the trace itself and
+    never go into the store, where they'd take the place of the profiles of later requests"""
+    if parallel:
+        return function_mappings
+    return PHPTraceParser.TraceDefinitions(function_mappings)
+
+def trace_calls(path, function_mappings, jobs=1):
+    """Generates all calls of a trace of a finished request"""
+    with elapsed_timer() as trace_timer:
+        trace = create_trace(path, function_mappings)
+    print("Took {:.4f} seconds to tokenize trace".format(trace_timer()))
+
+    yield from parse_trace(trace, jobs)
+
+def insert_request_in_db(conn, requests, uid, autoRemove=False, jobs=1, mapping_store=None):
     request = requests[uid]
 
-    profiles = request['profile']
+    if mapping_store is None:
+        mapping_store = FunctionMappingStore(conn)
+
     traces = request['trace']
 
     if not request_exists(uid, conn):
-        profile_filenames = [os.path.join(traceDir, profile['filename']) for profile in profiles]
-
-        with elapsed_timer() as profiler_timer:
-            function_mappings = PHPProfileParser.get_function_file_mapping(profile_filenames)
-        print("Took {:.4f} seconds to parse profile".format(profiler_timer()))
-
-        for trace in traces:
-            with elapsed_timer() as trace_timer:
-                trace = create_trace(trace['path'], function_mappings)
-            print("Took {:.4f} seconds to tokenize trace".format(trace_timer()))
-
-            insert_trace(trace, uid, conn)
+        request_tails = tails.pop(uid, None)
+
+        with request_transaction(conn, mapping_store):
+            if request_tails is None:
+                remove_partial_request(uid, conn)
+
+            profile_filenames = request_profile_filenames(request)
+            function_mappings, parallel = request_function_mappings(profile_filenames, mapping_store, jobs)
+
+            for trace in traces:
+                tail, first_id = request_tails.get(trace['path'], (None, None)) if request_tails else (None, None)
+
+                if tail is not None:
+                    # the open calls refer to this same mapping, so they get their definitions too
+                    definitions = tail.trace.function_mappings
+                    definitions.known.add_profiles(profile_filenames)
+                    insert_calls(tail.close(), uid, conn, first_id)
+                else:
+                    definitions = trace_definitions(function_mappings, parallel)
+                    insert_calls(trace_calls(trace['path'], definitions, jobs), uid, conn)
+                # known first, then what the trace taught
+                repair_definition_filenames(uid, definitions, conn)
             insert_request(uid, conn)
 
         if autoRemove:
@@ -305,94 +816,335 @@ def insert_request_in_db(conn, requests, uid, autoRemove=False):
         if autoRemove:
             remove_request_files(request)
 
-def file_is_available(filename):
+def prepare_request(request, known_definitions, prepared):
+    """Parses the traces of a finished request into CallBatches, in a worker process of `import_requests`
+
+    Workers can't use the database, the function definitions come from a snapshot
+    of the store. The CallBatches are put on `prepared` as they're made, a queue
+    of at most PREPARED_BATCHES, so a worker only gets that far ahead of the writer:
+
+        ('batch', CallBatch)
+        ('trace', (what the trace taught, what the profiles added to the store))   after the batches of a trace
+        ('done', None)
+    """
+    mapping_store = FunctionMappingStore(None, known_definitions)
+    function_mappings, _ = request_function_mappings(request_profile_filenames(request), mapping_store)
+
+    for trace in request['trace']:
+        definitions = trace_definitions(function_mappings)
+        for chunk in batches(trace_calls(trace['path'], definitions), INSERT_BATCH_SIZE):
+            prepared.put(('batch', prepare_calls(chunk)))
+        prepared.put(('trace', (definitions.learned, mapping_store.merged)))
+    prepared.put(('done', None))
+
+def prepared_batches(prepared, future):
+    """What `prepare_request` puts on `prepared`, until it's done
+
+    Raises the exception of the worker if it fails"""
+    while True:
+        try:
+            kind, item = prepared.get(timeout=TAIL_INTERVAL)
+        except queue.Empty:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+            continue
+        if kind == 'done':
+            return
+        yield kind, item
+
+def with_known_definitions(batch, mapping):
+    """A CallBatch prepared with a snapshot of the store, with the definitions the store has now
+
+    Requests written after the snapshot was taken can have taught it what the worker had to guess"""
+    file_names = {}
+    invocations = []
+    for invocation in batch.invocations:
+        definition = mapping.get(invocation[0])
+        if definition is not None and definition != invocation[3]:
+            invocation = invocation[:3] + (definition, ) + invocation[4:]
+        invocations.append(invocation)
+        # in the order of `prepare_calls`, the guesses that were replaced aren't stored
+        file_names[invocation[3]] = ()
+        file_names[invocation[2]] = ()
+    return batch._replace(file_names=file_names, invocations=invocations)
+
+def write_request(conn, uid, request, prepared, mapping_store, autoRemove=False):
+    """Writes a request as `prepare_request` prepares it, see `prepared_batches`"""
+    with request_transaction(conn, mapping_store):
+        remove_partial_request(uid, conn)
+
+        first_id = None
+        for kind, item in prepared:
+            if kind == 'batch':
+                if first_id is None:
+                    first_id = first_invocation_id(conn)
+                write_calls(with_known_definitions(item, mapping_store.mapping), uid, conn, first_id)
+                continue
+
+            learned, merged = item
+            mapping_store.merge(merged)
+            # known first, then what the trace taught
+            repair_definition_filenames(uid, PHPTraceParser.TraceDefinitions(mapping_store.mapping, learned), conn)
+            first_id = None
+        insert_request(uid, conn)
+
+    if autoRemove:
+        remove_request_files(request)
+
+def import_requests(databases, requests, processes, autoRemove, evt_queue, evt_loop):
+    """Prepares several requests at once in a process pool, while this thread writes them one by one
+
+    At most `processes` prepared requests wait for the writer, each of them
+    at most PREPARED_BATCHES CallBatches ahead, so a backlog of traces doesn't
+    pile up in memory when writing falls behind"""
+    waiting = queue.Queue(maxsize=processes)
+    # tailed and already imported requests are left to insert_request_in_db
+    sequential = {uid for uid in requests if uid in tails or (databases.created(requests[uid]) and request_exists(uid, databases.connection(requests[uid])))}
+    known_definitions = {}
+    """FunctionMappingStore > snapshot of its mapping, for the workers"""
+    request_definitions = {}
+    definitions = {}
+    for uid in requests:
+        # a shard is only created by the writer, once it inherits the definitions of the shards written before,
+        # until then the workers make do with those of the shard before (see with_known_definitions)
+        if databases.created(requests[uid]):
+            mapping_store = databases.for_request(requests[uid])[1]
+            if mapping_store not in known_definitions:
+                known_definitions[mapping_store] = dict(mapping_store.mapping)
+            definitions = known_definitions[mapping_store]
+        request_definitions[uid] = definitions
+
+    def submit(executor, manager):
+        try:
+            for uid in requests:
+                future, prepared = None, None
+                if uid not in sequential:
+                    # the workers only get a proxy of a Manager's queue
+                    prepared = manager.Queue(maxsize=PREPARED_BATCHES)
+                    future = executor.submit(prepare_request, requests[uid], request_definitions[uid], prepared)
+                waiting.put((uid, future, prepared))
+        finally:
+            waiting.put((None, None, None))
+
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=processes) as executor:
+        submitter = threading.Thread(target=submit, args=(executor, manager), daemon=True)
+        submitter.start()
+
+        while True:
+            uid, future, prepared = waiting.get()
+            if uid is None:
+                break
+
+            print("Found request --{}--".format(uid))
+            conn, mapping_store = databases.for_request(requests[uid])
+            try:
+                if future is None:
+                    insert_request_in_db(conn, requests, uid, autoRemove, 1, mapping_store)
+                else:
+                    batches_of_request = prepared_batches(prepared, future)
+                    try:
+                        write_request(conn, uid, requests[uid], batches_of_request, mapping_store, autoRemove)
+                    finally:
+                        # a worker that's ahead would wait for room in the queue forever
+                        for _ in batches_of_request:
+                            pass
+            except Exception as e:
+                print("Error while processing, moving on to the next")
+                traceback.print_exc()
+            print("Done processing request --{}--\n".format(uid))
+            asyncio.run_coroutine_threadsafe(evt_queue.put({'uid': uid}), evt_loop)
+
+        submitter.join()
+
+def file_is_available(filename, in_use=None):
     """
     Checks if a file is in use by another process
     https://stackoverflow.com/a/37256114/2302759
 
-    The SO thread also includes solutions for Linux.
+    On Linux `in_use` is what traceWatcher.files_in_use() returned, so /proc
+    is only read once for many files. A file no process is seen to have open is
+    available, unless not all processes could be seen and it was just modified,
+    see traceWatcher.file_is_settled. Without seeing every process, traces are
+    only available once they end, see traceWatcher.trace_has_ended.
     """
-    if not sys.platform == "win32":
-        raise Exception("`check_if_file_is_available` is only implemented for Windows, the program will not work correctly on other operating systems.")
+    if not os.path.exists(filename):
+        return False
 
-    if os.path.exists(filename):
+    if sys.platform == "win32":
         try:
             os.rename(filename, filename)
             return True
         except OSError as e:
             return False
-    return False
 
-def get_unique_requests_from_folder(traceDir):
-    """id > profile/trace > []"""
-    requestFiles = [parse_request_filename(tp) for tp in os.listdir(traceDir)]
+    if in_use is not None:
+        paths, complete = in_use
+        if os.path.realpath(filename) in paths:
+            return False
+        if complete:
+            return True
+    if not traceWatcher.file_is_settled(filename):
+        return False
+    info = parse_request_filename(os.path.basename(filename))
+    return not (info and info['type'] == 'trace') or traceWatcher.trace_has_ended(filename)
+
+def request_id_of(filename):
+    info = parse_request_filename(filename)
+    return info['request_id'] if info else None
+
+def get_unique_requests_from_folder(traceDir, busy=None, filenames=None):
+    """id > profile/trace > [], the requests that ran first first
+
+    Only looks at `filenames` if given, instead of everything in the directory.
+    The files of requests that aren't released yet are collected in `busy`, if given"""
+    if filenames is None:
+        filenames = os.listdir(traceDir)
+    requestFiles = [parse_request_filename(tp) for tp in filenames]
     requestFiles = [file for file in requestFiles if file]
 
     requests = {}
 
     for request in requestFiles:
         request["path"] = os.path.join(traceDir, request['filename'])
-
-        if request["request_id"] not in requests:
-            if not file_is_available(request["path"]):
-                # don't allow this trace-id to be processed at all
-                # consider this scenario
-                # there are four files
-                # each have the same request-id (this happens for instance with exception handling)
-                # the second set of .xt and .xp files are released by apache
-                # the first two aren't
-                #
-                # the second relies on the first, and therefore we can't process
-                # the request yet.
-                # This request should be ignored. The requests get cleaned up later in this function
-                requests[request["request_id"]] = None
-                print("Request {id} exists, but one or more files are not yet released by apache".format(id=request["request_id"]))
-                continue
-            else:
-                requests[request["request_id"]] = {}
-
         request_id = request["request_id"]
         request_type = request["type"]
-
-        if requests[request_id] == None:
-            continue
+        requests.setdefault(request_id, {}).setdefault(request_type, []).append(request)
+
+    in_use = traceWatcher.files_in_use() if requests else None
+    for request_id, files in list(requests.items()):
+        if not all(file_is_available(request["path"], in_use) for requests_of_type in files.values() for request in requests_of_type):
+            # don't allow this trace-id to be processed at all
+            # consider this scenario
+            # there are four files
+            # each have the same request-id (this happens for instance with exception handling)
+            # the second set of .xt and .xp files are released by apache
+            # the first two aren't
+            #
+            # the second relies on the first, and therefore we can't process
+            # the request yet.
+            del requests[request_id]
+            print("Request {id} exists, but one or more files are not yet released by apache".format(id=request_id))
+            if busy is not None:
+                busy[request_id] = files
+
+    # so a backlog is written to one shard after the other, see shardedDatabase.ShardWriter
+    return dict(sorted(requests.items(), key=lambda item: request_timestamp(item[1])))
+
+
+class Databases:
+    """Where requests are written: `db_name`, or the shard of the day they ran on (see shardedDatabase)"""
+
+    def __init__(self, db_name, shard_dir=None):
+        self.shards = shardedDatabase.ShardWriter(shard_dir, open_shard) if shard_dir else None
+        self.conn = None if self.shards else open_shard(db_name)
+        self.mapping_stores = {}
+        """connection > FunctionMappingStore"""
+
+    def connection(self, request=None):
+        if self.shards is None:
+            return self.conn
+        return self.shards.connection(request_timestamp(request) if request else None)
+
+    def created(self, request):
+        """Whether the database `request` is written to exists yet, shards are created when they're first written to"""
+        return self.shards is None or os.path.exists(self.shards.path(request_timestamp(request)))
+
+    def for_request(self, request=None):
+        """The connection of a request and the FunctionMappingStore of that database"""
+        conn = self.connection(request)
+        if self.shards is not None:
+            # the stores of shards that were closed in the meantime
+            open_connections = set(self.shards.connections.values())
+            self.mapping_stores = {c: store for c, store in self.mapping_stores.items() if c in open_connections}
+        if conn not in self.mapping_stores:
+            self.mapping_stores[conn] = FunctionMappingStore(conn)
+        return conn, self.mapping_stores[conn]
+
+    def close(self):
+        if self.shards is not None:
+            self.shards.close()
         else:
-            if request_type in requests[request_id]:
-                requests[request_id][request_type].append(request)
-            else:
-                requests[request_id][request_type] = [request]
+            self.conn.close()
 
-    # clean up unready requests
-    unready_keys = [key for key in requests.keys() if requests[key] == None]
-    for unready_key in unready_keys:
-        del requests[unready_key]
-
-    return requests
+def request_timestamp(request):
+    """When a request ran, the time in the name of its first file"""
+    return min(file['timestamp'] for files in request.values() for file in files)
 
+def open_databases(db, nodb, shard_dir=None):
+    if nodb:
+        return Databases(":memory:")
+    return Databases(db, shard_dir)
 
-def run(db, nodb, request, autoRemove, autoImport, evt_queue, evt_loop):
-    db_name = db
+def run(db, nodb, request, autoRemove, autoImport, evt_queue, evt_loop, jobs=1, tail=False, processes=1, filenames=None, shard_dir=None, databases=None):
+    """Imports the requests in the trace directory, or only those of `filenames`
 
-    if nodb:
-        db_name = ":memory:"
+    The databases are opened (and set up) for this run only, unless `databases` are given.
+    Returns the ids of the requests that were skipped because their files aren't released yet"""
+    busy = {}
 
-    with open_db_connection(db_name) as conn:
-        set_up_db(conn)
+    opened = databases is None
+    if opened:
+        databases = open_databases(db, nodb, shard_dir)
+    try:
         if request:
-            insert_request_in_db(conn, request, autoRemove)
+            conn, mapping_store = databases.for_request()
+            insert_request_in_db(conn, request, autoRemove, mapping_store=mapping_store)
 
         if autoImport:
-            requests = get_unique_requests_from_folder(traceDir)
+            requests = get_unique_requests_from_folder(traceDir, busy, filenames)
 
-            for uid in requests:
-                print("Found request --{}--".format(uid))
+            if processes > 1:
+                import_requests(databases, requests, processes, autoRemove, evt_queue, evt_loop)
+            else:
+                for uid in requests:
+                    print("Found request --{}--".format(uid))
+                    conn, mapping_store = databases.for_request(requests[uid])
+                    try:
+                        insert_request_in_db(conn, requests, uid, autoRemove, jobs, mapping_store)
+                    except Exception as e:
+                        print("Error while processing, moving on to the next")
+                        traceback.print_exc()
+                    print("Done processing request --{}--\n".format(uid))
+                    asyncio.run_coroutine_threadsafe(evt_queue.put({'uid': uid}), evt_loop)
+
+            for uid, files in busy.items() if tail else ():
+                conn, mapping_store = databases.for_request(files)
                 try:
-                    insert_request_in_db(conn, requests, uid, autoRemove)
+                    tail_request(conn, files, uid, mapping_store)
                 except Exception as e:
-                    print("Error while processing, moving on to the next")
+                    print("Error while tailing running request --{}--".format(uid))
                     traceback.print_exc()
-                print("Done processing request --{}--\n".format(uid))
-                asyncio.run_coroutine_threadsafe(evt_queue.put({'uid': uid}), evt_loop)
+    finally:
+        if opened:
+            databases.close()
+
+    return set(busy)
+
+def watch(db, nodb, request, autoRemove, autoImport, evt_queue, evt_loop, jobs=1, tail=False, processes=1, shard_dir=None):
+    """`run` for the requests whose files were just completed, as soon as they are, see traceWatcher.TraceWatcher
+
+    Requests that are still running (with `tail`) or whose files aren't released
+    yet are looked at again every TAIL_INTERVAL, the rest of the directory isn't.
+    The databases stay open in between"""
+    databases = open_databases(db, nodb, shard_dir)
+    with closing(databases), traceWatcher.TraceWatcher(traceDir, request_id_of) as watcher:
+        # whatever was there before
+        busy = run(db, nodb, request, autoRemove, autoImport, evt_queue, evt_loop, jobs, tail, processes, databases=databases)
+
+        while True:
+            polled = busy | (watcher.writing_keys() if tail else set())
+            keys = watcher.wait(TAIL_INTERVAL if polled else None)
+
+            if keys is None:
+                print("Missed changes in the trace directory, looking at all of it")
+                filenames = None
+            else:
+                polled = busy | (watcher.writing_keys() if tail else set())
+                filenames = watcher.filenames(set(keys) | polled)
+                if not filenames:
+                    continue
+
+            busy = run(db, nodb, None, autoRemove, autoImport, evt_queue, evt_loop, jobs, tail, processes, filenames, databases=databases)
 
 
 if __name__ == '__main__':
@@ -403,11 +1155,14 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    if args.watch:
+    if args.watch and traceWatcher.available():
+        print("Watching for changes.")
+        watch(args.db, args.nodb, args.request, args.autoRemove, args.autoImport, evt_queue, evt_loop, args.jobs, args.tail, args.processes, shard_dir=args.shard_dir)
+    elif args.watch:
         print("Watching for changes.")
         sched = BlockingScheduler()
-        sched.add_job(run, 'interval', seconds=1, args=(args.db, args.nodb, args.request, args.autoRemove, args.autoImport, evt_queue, evt_loop), max_instances=1)
+        sched.add_job(run, 'interval', seconds=1, args=(args.db, args.nodb, args.request, args.autoRemove, args.autoImport, evt_queue, evt_loop, args.jobs, args.tail, args.processes, None, args.shard_dir), max_instances=1)
         sched.start()
         sched.shutdown()
     else:
-        run(args.db, args.nodb, args.request, args.autoRemove, args.autoImport)
+        run(args.db, args.nodb, args.request, args.autoRemove, args.autoImport, evt_queue, evt_loop, args.jobs, args.tail, args.processes, shard_dir=args.shard_dir)
@@ -0,0 +1,246 @@
+"""Exports the invocations of a range of requests as columns that NumPy and pandas can memory-map.
+
+    python3 exportInvocations.py --out export --since 2026-10-01 --until 2026-10-08
+    python3 exportInvocations.py --out export --request XCYtdawTEVEAAB4EDbsAAAA-
+
+Every column is an .npy file in the output directory, row `i` of each is the same invocation,
+in the order the requests were imported:
+
+    invocation_id       int64    `function_invocations`.`id`
+    request             int32    index in requests.json
+    function            int32    index in function_names.json
+    calling_file        int32    index in file_names.json
+    definition_file     int32    index in file_names.json, -1 when unknown
+    linenum             int32
+    returnval           int64    rowid in `values`, -1 when unknown
+    time                float64  NaN when unknown
+    memory              float64  NaN when unknown
+
+Void calls return the `'NULL'` value like calls that `return null;`, xdebug doesn't tell them apart.
+
+The parameters of invocation `i` are `parameter_values[parameter_offsets[i]:parameter_offsets[i + 1]]`,
+rowids in `values` (compressed sparse rows). Aggregations then don't need a join:
+
+    export = load("export")
+    functions = pandas.Categorical.from_codes(export['function'], export['function_names'])
+    pandas.Series(export['time']).groupby(functions).sum()
+
+Value texts aren't exported, `values` ids only mean something in the database they came from.
+With --shard-dir every shard that has requests in the range is exported to a directory of its own.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import settings
+import shardedDatabase
+from collectFunctionCalls import elapsed_timer
+
+EXPORT_BATCH_SIZE = 100000
+"""Rows fetched from SQLite at a time, the columns themselves are written to memory-mapped files"""
+
+INVOCATION_COLUMNS = {
+    'invocation_id': np.int64,
+    'request': np.int32,
+    'function': np.int32,
+    'calling_file': np.int32,
+    'definition_file': np.int32,
+    'linenum': np.int32,
+    'returnval': np.int64,
+    'time': np.float64,
+    'memory': np.float64,
+}
+"""column > dtype, in the order of INVOCATIONS_QUERY (`request` isn't queried)"""
+
+ENCODED_COLUMNS = {
+    'function': 'function_names',
+    'calling_file': 'file_names',
+    'definition_file': 'file_names',
+}
+"""column > name list its rowids are turned into positions in"""
+
+NAME_TABLES = {
+    'requests': None,
+    'function_names': 'function_names',
+    'file_names': 'file_names',
+}
+"""name list > table it comes from, saved as <name list>.json"""
+
+INVOCATIONS_QUERY = """
+SELECT
+    `f`.`id`,
+    COALESCE(`f`.`name`, -1),
+    COALESCE(`f`.`calling_filename`, -1),
+    COALESCE(`f`.`definition_filename`, -1),
+    COALESCE(`f`.`linenum`, -1),
+    COALESCE(`f`.`returnval`, -1),
+    CAST(decompress_value(`t`.`value`, `t`.`compression`) AS REAL),
+    CAST(decompress_value(`m`.`value`, `m`.`compression`) AS REAL)
+FROM `function_invocations` `f`
+    LEFT JOIN `values` `t` ON `f`.`time` = `t`.`rowid`
+    LEFT JOIN `values` `m` ON `f`.`memory` = `m`.`rowid`
+WHERE `f`.`requestname` = ?
+ORDER BY `f`.`id`
+"""
+
+PARAMETERS_QUERY = """
+SELECT `p`.`invocation_id`, `p`.`value_id`
+FROM `function_invocations` `f`
+    JOIN `invocation_parameters` `p` ON `p`.`invocation_id` = `f`.`id`
+WHERE `f`.`requestname` = ?
+ORDER BY `p`.`invocation_id`, `p`.`position`
+"""
+
+PARAMETER_COUNT_QUERY = """
+SELECT COUNT(*)
+FROM `function_invocations` `f`
+    JOIN `invocation_parameters` `p` ON `p`.`invocation_id` = `f`.`id`
+WHERE `f`.`requestname` = ?
+"""
+
+parser = argparse.ArgumentParser(description="Export invocations as memory-mappable NumPy columns")
+parser.add_argument('-d', '--db', nargs="?", dest="db", type=str, default="function-calls.db", help="name of the sqlite3 .db file")
+parser.add_argument('-s', '--shard-dir', nargs="?", dest="shard_dir", type=str, default=getattr(settings, 'shard_dir', None), help="Export the shards in this directory instead")
+parser.add_argument('-o', '--out', nargs="?", dest="out", type=str, required=True, help="Directory the columns are written to")
+parser.add_argument('--since', nargs="?", dest="since", type=str, default=None, help="Only requests imported at or after this ISO date(time)")
+parser.add_argument('--until', nargs="?", dest="until", type=str, default=None, help="Only requests imported before this ISO date(time)")
+parser.add_argument('-r', '--request', action="append", dest="requests", default=None, help="Only this request, can be given more than once")
+
+
+def requests_in_range(conn, since=None, until=None, requests=None):
+    """Names of the imported requests in the range, in the order they were imported"""
+    c = conn.cursor()
+    c.execute("SELECT `requestname`, MAX(`timestamp`) FROM `traces` GROUP BY `requestname` ORDER BY 2, 1")
+    return [
+        requestname for requestname, timestamp in c.fetchall()
+        if (since is None or timestamp >= since)
+        and (until is None or timestamp < until)
+        and (requests is None or requestname in requests)
+    ]
+
+
+def name_table(conn, table):
+    """The rowids of `table`, sorted, and the names at the same positions"""
+    rows = conn.execute("SELECT `rowid`, `name` FROM `{}` ORDER BY `rowid`".format(table)).fetchall()
+    return np.array([rowid for rowid, _ in rows], dtype=np.int64), [name for _, name in rows]
+
+
+def encode(rowids, ids):
+    """Positions of `ids` in the sorted `rowids`, -1 stays -1"""
+    codes = np.searchsorted(rowids, ids).astype(np.int32)
+    codes[ids < 0] = -1
+    return codes
+
+
+def open_column(directory, name, dtype, length):
+    return np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode="w+", dtype=dtype, shape=(length, ))
+
+
+def export(conn, directory, requests):
+    """Writes the invocations of `requests` to `directory`, returns the number of invocations and parameters
+
+    `conn` needs `decompress_value`, see shardedDatabase.connect"""
+    os.makedirs(directory, exist_ok=True)
+    c = conn.cursor()
+
+    invocation_counts = [c.execute("SELECT COUNT(*) FROM `function_invocations` WHERE `requestname`=?", (requestname, )).fetchone()[0] for requestname in requests]
+    parameter_counts = [c.execute(PARAMETER_COUNT_QUERY, (requestname, )).fetchone()[0] for requestname in requests]
+    invocations, parameters = sum(invocation_counts), sum(parameter_counts)
+
+    names = {name_list: name_table(conn, table) for name_list, table in NAME_TABLES.items() if table}
+    columns = {column: open_column(directory, column, dtype, invocations) for column, dtype in INVOCATION_COLUMNS.items()}
+    queried = [(column, dtype) for column, dtype in INVOCATION_COLUMNS.items() if column != 'request']
+    parameter_offsets = open_column(directory, "parameter_offsets", np.int64, invocations + 1)
+    parameter_values = open_column(directory, "parameter_values", np.int64, parameters)
+
+    start = 0
+    parameter_start = 0
+    for code, requestname in enumerate(requests):
+        end = start + invocation_counts[code]
+        columns['request'][start:end] = code
+
+        c.execute(INVOCATIONS_QUERY, (requestname, ))
+        row = start
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            batch = slice(row, row + len(rows))
+            # None becomes NaN in the float columns
+            for (column, dtype), values in zip(queried, zip(*rows)):
+                if column in ENCODED_COLUMNS:
+                    values = encode(names[ENCODED_COLUMNS[column]][0], np.array(values, dtype=np.int64))
+                columns[column][batch] = np.array(values, dtype=dtype)
+            row += len(rows)
+
+        # parameters per invocation, the ids of a request are sorted
+        ids = columns['invocation_id'][start:end]
+        counts = np.zeros(len(ids), dtype=np.int64)
+        c.execute(PARAMETERS_QUERY, (requestname, ))
+        parameter = parameter_start
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            invocation_id, value_id = (np.array(values, dtype=np.int64) for values in zip(*rows))
+            np.add.at(counts, np.searchsorted(ids, invocation_id), 1)
+            parameter_values[parameter:parameter + len(rows)] = value_id
+            parameter += len(rows)
+
+        parameter_offsets[start + 1:end + 1] = parameter_start + np.cumsum(counts)
+        start, parameter_start = end, parameter
+
+    parameter_offsets[0] = 0
+    for column in list(columns.values()) + [parameter_offsets, parameter_values]:
+        column.flush()
+
+    for name_list in NAME_TABLES:
+        with open(os.path.join(directory, name_list + ".json"), "w", encoding="utf-8") as f:
+            json.dump(requests if name_list == 'requests' else names[name_list][1], f, ensure_ascii=False)
+
+    return invocations, parameters
+
+
+def load(directory, mmap_mode="r"):
+    """The columns and name lists of an export, the columns memory-mapped"""
+    export = {}
+    for column in list(INVOCATION_COLUMNS) + ["parameter_offsets", "parameter_values"]:
+        export[column] = np.load(os.path.join(directory, column + ".npy"), mmap_mode=mmap_mode)
+    for name_list in NAME_TABLES:
+        with open(os.path.join(directory, name_list + ".json"), encoding="utf-8") as f:
+            export[name_list] = json.load(f)
+    return export
+
+
+def export_database(db_name, directory, since=None, until=None, requests=None):
+    federation = shardedDatabase.connect(None, db_name)
+    selected = requests_in_range(federation.conn, since, until, requests)
+    if not selected:
+        federation.close()
+        return False
+
+    with elapsed_timer() as export_timer:
+        invocations, parameters = export(federation.conn, directory, selected)
+    print("Took {:.4f}s to export {} requests with {} invocations and {} parameters to {}".format(
+        export_timer(), len(selected), invocations, parameters, directory
+    ))
+    federation.close()
+    return True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    requests = set(args.requests) if args.requests else None
+
+    if args.shard_dir:
+        exported = [
+            export_database(path, os.path.join(args.out, os.path.basename(path)[:-len(shardedDatabase.SHARD_SUFFIX)]), args.since, args.until, requests)
+            for path in shardedDatabase.shard_paths(args.shard_dir)
+        ]
+    else:
+        exported = [export_database(args.db, args.out, args.since, args.until, requests)]
+
+    if not any(exported):
+        print("No requests in the range")
@@ -0,0 +1,242 @@
+"""Removes old requests from the function-calls database, and whatever only they referred to.
+
+    python3 retention.py --max-age 30           # requests imported more than 30 days ago
+    python3 retention.py --keep 1000            # all but the newest 1000 requests
+    python3 retention.py --shard-dir ... --max-age 30
+
+Requests are deleted a batch of invocations at a time, so the ingest and readers
+aren't blocked for long. `values`, `file_names` and `function_names` that no
+invocation refers to anymore are removed afterwards, a batch of rowids at a time,
+`function_definitions` is kept.
+The freed pages are handed back to the file system a few at a time (`auto_vacuum` INCREMENTAL),
+databases created before that was set up keep reusing them for new rows instead,
+`--enable-auto-vacuum` converts them with a single (blocking) VACUUM.
+
+Shards (see shardedDatabase) are removed as whole files.
+"""
+import argparse
+import datetime
+import os
+
+import settings
+import shardedDatabase
+from collectFunctionCalls import elapsed_timer, open_shard
+
+DELETE_BATCH_SIZE = 10000
+"""Invocations deleted per transaction"""
+
+COLLECT_BATCH_SIZE = 100000
+"""Rowids of a lookup table checked for garbage per transaction"""
+
+MARKED_TABLES = {
+    'values': (("invocation_parameters", "value_id"), ("function_invocations", "returnval"), ("function_invocations", "memory"), ("function_invocations", "time")),
+    'file_names': (("function_invocations", "calling_filename"), ("function_invocations", "definition_filename")),
+}
+"""lookup table > the columns referring to it, that aren't indexed"""
+
+VACUUM_PAGES = 1024
+"""Pages handed back to the file system per transaction"""
+
+parser = argparse.ArgumentParser(description="Remove old requests from the function-calls database")
+parser.add_argument('-d', '--db', nargs="?", dest="db", type=str, default="function-calls.db", help="name of the sqlite3 .db file")
+parser.add_argument('-s', '--shard-dir', nargs="?", dest="shard_dir", type=str, default=getattr(settings, 'shard_dir', None), help="Remove whole shards from this directory instead")
+parser.add_argument('-a', '--max-age', nargs="?", dest="max_age", type=float, default=getattr(settings, 'retention_days', None), help="Remove requests imported more than this many days ago")
+parser.add_argument('-k', '--keep', nargs="?", dest="keep", type=int, default=None, help="Remove all but this many of the newest requests")
+parser.add_argument('--enable-auto-vacuum', action="store_true", dest="enable_auto_vacuum", default=False, help="VACUUM a database from before `auto_vacuum` was set, once")
+
+
+def database_size(conn):
+    """Bytes in use by the database, and bytes on its free list"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_count * page_size, freelist_count * page_size
+
+
+def expired_requests(conn, max_age=None, keep=None):
+    """Names of the requests the policy removes, oldest first
+
+    Only finished requests have a `traces` row, the ones that are being tailed are left alone"""
+    c = conn.cursor()
+    c.execute("SELECT `requestname`, MAX(`timestamp`) FROM `traces` GROUP BY `requestname` ORDER BY 2")
+    requests = c.fetchall()
+
+    expired = set()
+    if max_age is not None:
+        cutoff = (datetime.datetime.today() - datetime.timedelta(days=max_age)).isoformat()
+        expired.update(requestname for requestname, timestamp in requests if timestamp < cutoff)
+    if keep is not None:
+        expired.update(requestname for requestname, _ in requests[:max(len(requests) - keep, 0)])
+
+    return [requestname for requestname, _ in requests if requestname in expired]
+
+
+def delete_request(conn, requestname):
+    """Removes a request a DELETE_BATCH_SIZE invocations at a time
+
+    The `traces` row goes last, an interrupted removal is finished by the next run"""
+    c = conn.cursor()
+    deleted = 0
+    while True:
+        c.execute(
+            "SELECT `id` FROM `function_invocations` WHERE `requestname`=? LIMIT ?",
+            (requestname, DELETE_BATCH_SIZE)
+        )
+        ids = [(invocation_id, ) for invocation_id, in c.fetchall()]
+        if not ids:
+            break
+
+        c.executemany("DELETE FROM `invocation_parameters` WHERE `invocation_id`=?", ids)
+        c.executemany("DELETE FROM `function_invocations` WHERE `id`=?", ids)
+        conn.commit()
+        deleted += len(ids)
+
+    c.execute("DELETE FROM `traces` WHERE `requestname`=?", (requestname, ))
+    conn.commit()
+    return deleted
+
+
+def collect_garbage(conn):
+    """Removes the `values`, `file_names` and `function_names` no invocation refers to
+
+    What `values` and `file_names` are referred to is read once, without blocking the ingest.
+    The rest is removed COLLECT_BATCH_SIZE rowids per transaction, except for the ids the
+    requests written in the meantime noted in `garbage_collection` (see
+    collectFunctionCalls.keep_from_garbage_collection). `function_names` are checked one by
+    one, `function_invocations`.`name` is indexed. Returns the number of rows removed per table"""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    # an interrupted run leaves its ids behind
+    c.execute("DELETE FROM `garbage_collection`")
+    c.executemany("INSERT INTO `garbage_collection` VALUES (?, 0)", ((table, ) for table in MARKED_TABLES))
+    conn.commit()
+
+    try:
+        c.execute("BEGIN")
+        for table, references in MARKED_TABLES.items():
+            c.execute("CREATE TEMP TABLE `live_{}` (`id` INTEGER PRIMARY KEY)".format(table))
+            for referring_table, column in references:
+                c.execute("INSERT OR IGNORE INTO `live_{}` SELECT `{}` FROM `{}`".format(table, column, referring_table))
+        conn.commit()
+
+        removed = {}
+        for table in list(MARKED_TABLES) + ["function_names"]:
+            condition = """
+                NOT EXISTS (SELECT 1 FROM `live_{table}` `l` WHERE `l`.`id` = `{table}`.`rowid`)
+                AND NOT EXISTS (SELECT 1 FROM `garbage_collection` `g` WHERE `g`.`table_name` = '{table}' AND `g`.`id` = `{table}`.`rowid`)
+            """.format(table=table) if table in MARKED_TABLES else """
+                NOT EXISTS (SELECT 1 FROM `function_invocations` `f` WHERE `f`.`name` = `function_names`.`rowid`)
+            """
+
+            removed[table] = 0
+            last = c.execute("SELECT IFNULL(MAX(`rowid`), 0) FROM `{}`".format(table)).fetchone()[0]
+            for start in range(1, last + 1, COLLECT_BATCH_SIZE):
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(
+                    "DELETE FROM `{}` WHERE `rowid` >= ? AND `rowid` < ? AND {}".format(table, condition),
+                    (start, start + COLLECT_BATCH_SIZE)
+                )
+                removed[table] += c.rowcount
+                conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        for table in MARKED_TABLES:
+            c.execute("DROP TABLE IF EXISTS `live_{}`".format(table))
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM `garbage_collection`")
+        conn.commit()
+
+    return removed
+
+
+def incremental_vacuum(conn):
+    """Hands the free pages back to the file system, VACUUM_PAGES per transaction
+
+    Returns False when the database doesn't have `auto_vacuum` INCREMENTAL"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return False
+
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        conn.execute("PRAGMA incremental_vacuum({})".format(VACUUM_PAGES)).fetchall()
+        conn.commit()
+        free, previous = conn.execute("PRAGMA freelist_count").fetchone()[0], free
+        if free == previous:
+            break
+
+    # the file only shrinks once the WAL is written back
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return True
+
+
+def enable_auto_vacuum(conn):
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    with elapsed_timer() as vacuum_timer:
+        conn.execute("VACUUM")
+    print("Took {:.4f}s to VACUUM".format(vacuum_timer()))
+
+
+def apply_retention(conn, max_age=None, keep=None):
+    """Removes the requests the policy doesn't keep and reclaims their space, returns the bytes freed"""
+    size_before, _ = database_size(conn)
+
+    requests = expired_requests(conn, max_age, keep)
+    with elapsed_timer() as delete_timer:
+        invocations = sum(delete_request(conn, requestname) for requestname in requests)
+    print("Took {:.4f}s to delete {} requests with {} `function_invocations`".format(delete_timer(), len(requests), invocations))
+
+    with elapsed_timer() as gc_timer:
+        removed = collect_garbage(conn)
+    print("Took {:.4f}s to delete {} `values`, {} `file_names` and {} `function_names` nothing refers to anymore".format(
+        gc_timer(), removed['values'], removed['file_names'], removed['function_names']
+    ))
+
+    with elapsed_timer() as vacuum_timer:
+        vacuumed = incremental_vacuum(conn)
+    size_after, free = database_size(conn)
+
+    if vacuumed:
+        print("Took {:.4f}s to free {} bytes".format(vacuum_timer(), size_before - size_after))
+    else:
+        print("{} bytes are free to be reused by new requests, the file doesn't shrink without --enable-auto-vacuum".format(free))
+    return size_before - size_after
+
+
+def remove_expired_shards(shard_dir, max_age, period='day'):
+    """Deletes the shards of periods that ended more than `max_age` days ago, returns the bytes freed
+
+    The shard of the current period and the newest one before it are always kept, a running
+    collectFunctionCalls.py may have those open (see shardedDatabase.ShardWriter)"""
+    cutoff = shardedDatabase.shard_filename(datetime.datetime.today() - datetime.timedelta(days=max_age), period)
+    current = shardedDatabase.shard_filename(datetime.datetime.today(), period)
+    paths = shardedDatabase.shard_paths(shard_dir)
+    previous = [path for path in paths if os.path.basename(path) < current][-1:]
+    freed = 0
+    for path in paths:
+        if os.path.basename(path) >= min(cutoff, current) or path in previous:
+            continue
+        for filename in (path, path + "-wal", path + "-shm"):
+            if os.path.exists(filename):
+                freed += os.path.getsize(filename)
+                os.unlink(filename)
+        print("Removed shard {}".format(os.path.basename(path)))
+    print("Freed {} bytes".format(freed))
+    return freed
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.split(__file__)[0])
+    args = parser.parse_args()
+
+    if args.shard_dir:
+        if args.max_age is None:
+            parser.error("shards are removed by --max-age")
+        remove_expired_shards(args.shard_dir, args.max_age)
+    else:
+        conn = open_shard(args.db)
+        if args.enable_auto_vacuum:
+            enable_auto_vacuum(conn)
+        if args.max_age is not None or args.keep is not None:
+            apply_retention(conn, args.max_age, args.keep)
+        conn.close()
@@ -1,6 +1,5 @@
 -- PRAGMA foreign_keys = ON;
--- PRAGMA page_size = 65536;
--- PRAGMA cache_size= 100000;
+-- page_size, cache_size, journal_mode etc. are set per connection, see storageProfiles.py
 
 
 
@@ -34,15 +33,31 @@ INSERT OR IGNORE INTO `value_types` (`php_type`) VALUES
 
 
 
+-- values are deduplicated on a 64-bit hash of `value`,
+-- so their (often huge) text doesn't have to be indexed.
+-- different values can share a hash, see collectFunctionCalls.py@value_hash
+-- large values are stored compressed, read them with decompress_value(`value`, `compression`),
+-- see valueCompression.py
 CREATE TABLE IF NOT EXISTS `values`
 (
     `value` TEXT,
     `php_type` INTEGER,
+    `hash` INTEGER,
+    `compression` INTEGER,
 
     FOREIGN KEY(`php_type`) REFERENCES `value_types`(`ROWID`)
 );
-CREATE UNIQUE INDEX IF NOT EXISTS `idx_values`
-ON `values`(`value`);
+CREATE INDEX IF NOT EXISTS `idx_values_hash`
+ON `values`(`hash`);
+
+
+
+-- preset dictionaries of compressed `values`, `id` is a hash of `dictionary`
+CREATE TABLE IF NOT EXISTS `compression_dictionaries`
+(
+    `id` INTEGER PRIMARY KEY,
+    `dictionary` BLOB
+);
 
 
 
@@ -55,7 +70,7 @@ ON `function_names`(`name`);
 
 CREATE TABLE IF NOT EXISTS `function_invocations`
 (
-    `hash` TEXT UNIQUE,
+    `id` INTEGER PRIMARY KEY,
     `name` INTEGER,
     `returnval` INTEGER,
     `calling_filename` INTEGER,
@@ -80,16 +95,45 @@ ON `function_invocations`(`requestname`);
 
 
 -- each function invocation has an associated set
--- of `n` parameters
+-- of `n` parameters, `position` starts at 0
 CREATE TABLE IF NOT EXISTS `invocation_parameters`
 (
-    `function_invocation_hash` TEXT,
+    `invocation_id` INTEGER,
+    `position` INTEGER,
     `value_id` INTEGER,
 
-    FOREIGN KEY(`function_invocation_hash`) REFERENCES `function_invocations`(`hash`),
+    PRIMARY KEY(`invocation_id`, `position`),
+    FOREIGN KEY(`invocation_id`) REFERENCES `function_invocations`(`id`),
     FOREIGN KEY(`value_id`) REFERENCES `values`(`ROWID`)
-);
-CREATE INDEX IF NOT EXISTS `idx_invocation_parameters_hash`
-ON `invocation_parameters`(`function_invocation_hash`);
+) WITHOUT ROWID;
 
 
+-- while retention.py collects the garbage of a lookup table (`id` 0 of it), the ids
+-- requests are written with, it doesn't remove them, see retention.collect_garbage
+CREATE TABLE IF NOT EXISTS `garbage_collection`
+(
+    `table_name` TEXT,
+    `id` INTEGER,
+    PRIMARY KEY(`table_name`, `id`)
+) WITHOUT ROWID;
+
+
+-- invocation ids kept free for the calls of traces that are being tailed, from `first_id`
+-- up to and including `reserved_until`, see collectFunctionCalls.py@reserve_invocation_ids
+CREATE TABLE IF NOT EXISTS `invocation_id_reservations`
+(
+    `requestname` TEXT,
+    `first_id` INTEGER,
+    `reserved_until` INTEGER,
+    PRIMARY KEY(`requestname`, `first_id`)
+) WITHOUT ROWID;
+
+
+-- where each function is defined, merged from the profiles
+-- of all ingested requests so they don't have to be parsed again
+CREATE TABLE IF NOT EXISTS `function_definitions`
+(
+    `function_name` TEXT,
+    `file_name` TEXT,
+    PRIMARY KEY(`function_name`)
+);
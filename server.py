@@ -1,42 +1,41 @@
 from flask import Flask, jsonify, render_template, request
 from flask_cors import CORS
-import sqlite3
 import settings
 import sqlparse
+import shardedDatabase
+
+def connect(db_name):
+    """All shards at once when `settings.shard_dir` is set, see shardedDatabase"""
+    return shardedDatabase.connect(getattr(settings, 'shard_dir', None), db_name)
 
 def get_requests():
-    conn = sqlite3.connect('R:/Temp/function-calls.db')
+    federation = connect('R:/Temp/function-calls.db')
 
-    query = """SELECT requestname, strftime('%d-%m %H:%M:%S', timestamp) FROM traces ORDER BY timestamp DESC"""
+    query = """SELECT requestname, timestamp FROM {shard}.traces"""
 
-    c = conn.cursor()
-    c.execute(query)
-    return c.fetchall()
+    return federation.query(query, outer="""SELECT requestname, strftime('%d-%m %H:%M:%S', timestamp) FROM ({}) ORDER BY timestamp DESC""")
 
-def get_paths_for_text_in_trace(conn, requestHash, text):
+def get_paths_for_text_in_trace(federation, requestHash, text):
     query = """
     SELECT f2.name,
            f4.name as `definition file`,
            f3.name as `calling file`,
            f.linenum,
-           group_concat(coalesce(v.value, '{{void}}'), ', ') as params
-    FROM function_invocations f
-           LEFT JOIN function_names f2 ON f.name = f2.rowid
-           LEFT JOIN file_names f3 on f.calling_filename = f3.rowid
-           LEFT JOIN file_names f4 on f.definition_filename = f4.rowid
-           LEFT JOIN invocation_parameters parameter on parameter.function_invocation_hash = cast(f.hash as text)
-           LEFT JOIN "values" v on parameter.value_id = v.rowid
-           LEFT JOIN "values" v2 on f.returnval = v2.rowid
+           group_concat(coalesce(decompress_value(v.value, v.compression), '{{void}}'), ', ') as params
+    FROM {shard}.function_invocations f
+           LEFT JOIN {shard}.function_names f2 ON f.name = f2.rowid
+           LEFT JOIN {shard}.file_names f3 on f.calling_filename = f3.rowid
+           LEFT JOIN {shard}.file_names f4 on f.definition_filename = f4.rowid
+           LEFT JOIN {shard}.invocation_parameters parameter on parameter.invocation_id = f.id
+           LEFT JOIN {shard}."values" v on parameter.value_id = v.rowid
+           LEFT JOIN {shard}."values" v2 on f.returnval = v2.rowid
     WHERE f.requestname=:requestHash
-    GROUP BY f.hash HAVING (params LIKE ('%' || :text || '%') OR returnval LIKE ('%' || :text || '%'))
+    GROUP BY f.id HAVING (params LIKE ('%' || :text || '%') OR returnval LIKE ('%' || :text || '%'))
     """
 
 
 
-    c = conn.cursor()
-    c.execute(query, { 'requestHash': requestHash, 'text': text })
-
-    paths = c.fetchall()
+    paths = federation.query(query, { 'requestHash': requestHash, 'text': text })
 
     content = ""
 
@@ -55,8 +54,8 @@ CORS(app)
 
 @app.route("/queryLinks/<requestHash>")
 def queryLinks(requestHash):
-    conn = sqlite3.connect('function-calls.db')
-    paths = get_paths_for_text_in_trace(conn, requestHash, request.args.get('text'))
+    federation = connect('function-calls.db')
+    paths = get_paths_for_text_in_trace(federation, requestHash, request.args.get('text'))
 
     return paths
 
@@ -68,22 +67,22 @@ def requests():
 def sqlColumnsInRequest(requestHash):
     """Fetches info about the sql tables, statements and columns accessed
     in a specified request based on the trace data."""
-    conn = sqlite3.connect('function-calls.db')
+    federation = connect('function-calls.db')
 
     query = """SELECT
       f2.name,
-      v.value,
+      decompress_value(v.value, v.compression) as query,
       f3.name,
       f.linenum,
-      m.value,
-      t.value
-    FROM function_invocations f
-        LEFT JOIN function_names f2 ON f.name = f2.rowid
-        LEFT JOIN invocation_parameters parameter on parameter.function_invocation_hash = f.hash
-        LEFT JOIN "values" v on parameter.value_id = v.rowid
-        LEFT JOIN file_names f3 on f.calling_filename = f3.rowid
-        LEFT JOIN `values` m on f.memory=m.rowid
-        LEFT JOIN `values` t on f.time=t.rowid
+      decompress_value(m.value, m.compression),
+      decompress_value(t.value, t.compression)
+    FROM {shard}.function_invocations f
+        LEFT JOIN {shard}.function_names f2 ON f.name = f2.rowid
+        LEFT JOIN {shard}.invocation_parameters parameter on parameter.invocation_id = f.id AND parameter.position = 0
+        LEFT JOIN {shard}."values" v on parameter.value_id = v.rowid
+        LEFT JOIN {shard}.file_names f3 on f.calling_filename = f3.rowid
+        LEFT JOIN {shard}.`values` m on f.memory=m.rowid
+        LEFT JOIN {shard}.`values` t on f.time=t.rowid
     WHERE f.requestname = :requestHash
       AND (f2.name = 'mysqli_query'
       OR f2.name = 'createQuery'
@@ -95,17 +94,13 @@ def sqlColumnsInRequest(requestHash):
       OR f2.name = 'fetchColumn'
       OR f2.name = 'fetchAssoc')
     GROUP BY
-      f.hash HAVING
-        (v.value LIKE '%SELECT%' OR
-         v.value LIKE '%UPDATE%' OR
-         v.value LIKE '%DELETE FROM%' OR
-         v.value LIKE '%INSERT INTO%')
-        AND parameter.rowid=MIN(parameter.ROWID)"""
-
-    c = conn.cursor()
-    c.execute(query, { 'requestHash': requestHash })
+      f.id HAVING
+        (query LIKE '%SELECT%' OR
+         query LIKE '%UPDATE%' OR
+         query LIKE '%DELETE FROM%' OR
+         query LIKE '%INSERT INTO%')"""
 
-    sqlCalls = c.fetchall()
+    sqlCalls = federation.query(query, { 'requestHash': requestHash })
 
     content = ""
 
@@ -4,3 +4,7 @@ traceDir = "R:/Temp"
 apache_start_command = "NET START wampstackApache"
 apache_stop_command = "NET STOP wampstackApache"
 php_ini_location = 'C:/Bitnami/wampstack-7.1.24-0/php/php.ini'
+
+# One database per day in this directory instead of a single function-calls.db,
+# collectFunctionCalls.py writes to them and server.py reads all of them, see shardedDatabase.py
+# shard_dir = "R:/Temp/function-calls"
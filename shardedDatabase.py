@@ -0,0 +1,202 @@
+"""Function calls split over one database per day (or week, month), instead of a single function-calls.db.
+
+Every shard is a complete database with the schema of schema.sql, holding the requests
+that ran in its period. Old shards can be archived or removed as whole files, and
+vacuumed or backed up one at a time.
+
+Reading attaches the shards to a connection, queries name their tables
+with a `{shard}.` prefix and are run on every shard at once:
+
+    federation = connect(settings.shard_dir)
+    federation.query(
+        "SELECT `requestname`, `timestamp` FROM {shard}.`traces`",
+        outer="SELECT * FROM ({}) ORDER BY `timestamp` DESC"
+    )
+
+Rows of different shards can't be joined, ids (`rowid`, `function_invocations`.`id`)
+are only unique within a shard. Every shard has to answer on its own, `outer` combines their rows.
+SQLite attaches only so many databases to a connection (SQLITE_MAX_ATTACHED, 10 by default),
+with more shards than that they're spread over several connections and `outer` is run on
+their rows once they're all read.
+"""
+import datetime
+import os
+import sqlite3
+from contextlib import closing
+
+import storageProfiles
+import valueCompression
+
+SHARD_PERIODS = {
+    'day': '%Y-%m-%d',
+    'week': '%G-W%V',
+    'month': '%Y-%m',
+}
+"""period > strftime format of the part of a shard's filename that tells its period, these sort by time"""
+
+SHARD_PREFIX = "function-calls-"
+SHARD_SUFFIX = ".db"
+
+
+def shard_filename(timestamp, period='day'):
+    return "{}{}{}".format(SHARD_PREFIX, timestamp.strftime(SHARD_PERIODS[period]), SHARD_SUFFIX)
+
+
+def shard_paths(shard_dir):
+    """Paths of all shards in `shard_dir`, oldest first"""
+    return [
+        os.path.join(shard_dir, filename)
+        for filename in sorted(os.listdir(shard_dir))
+        if filename.startswith(SHARD_PREFIX) and filename.endswith(SHARD_SUFFIX)
+    ]
+
+
+class ShardWriter:
+    """The open connections to the shards requests are written to
+
+    `open_shard` opens a shard by path and makes sure it has the schema,
+    see collectFunctionCalls.open_db_connection and set_up_db.
+    Once a shard of a newer period is opened those of older periods are closed,
+    a late request of an older period opens its shard again."""
+
+    def __init__(self, shard_dir, open_shard, period='day'):
+        self.shard_dir = shard_dir
+        self.open_shard = open_shard
+        self.period = period
+        self.connections = {}
+        """path > connection"""
+
+    def path(self, timestamp=None):
+        """The path of the shard of `timestamp`, now by default"""
+        return os.path.join(self.shard_dir, shard_filename(timestamp or datetime.datetime.today(), self.period))
+
+    def connection(self, timestamp=None):
+        """The connection to the shard of `timestamp`, now by default"""
+        path = self.path(timestamp)
+        conn = self.connections.get(path)
+        if conn is None:
+            previous = [other for other in shard_paths(self.shard_dir) if other < path]
+            conn = self.connections[path] = self.open_shard(path)
+            if previous:
+                inherit_definitions(conn, previous[-1])
+            for older in [other for other in self.connections if other < path]:
+                self.connections.pop(older).close()
+        return conn
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+
+def inherit_definitions(conn, previous_path):
+    """Gives a new shard the `function_definitions` and compression dictionaries of the shard before it
+
+    So its first requests can do without a profile, like they could in a single database,
+    and their values are compressed as well as those of the shard before"""
+    conn.execute("ATTACH DATABASE ? AS `previous`", (previous_path, ))
+    try:
+        for table, columns in (("function_definitions", "`function_name`, `file_name`"), ("compression_dictionaries", "`id`, `dictionary`")):
+            try:
+                conn.execute("INSERT OR IGNORE INTO `main`.`{table}` ({columns}) SELECT {columns} FROM `previous`.`{table}`".format(
+                    table=table, columns=columns
+                ))
+                conn.commit()
+            except sqlite3.OperationalError:
+                # from before the table existed
+                conn.rollback()
+    finally:
+        conn.execute("DETACH DATABASE `previous`")
+
+
+def federate(query, schemas):
+    """`query` for every shard of `schemas` as a single compound statement
+
+    `{shard}` in `query` is replaced by the schema of each shard"""
+    return " UNION ALL ".join(
+        "SELECT * FROM ({})".format(query.strip().rstrip(";").replace("{shard}", schema))
+        for schema in schemas
+    )
+
+
+def column_names(description):
+    """The column names of a cursor's rows, made unique the way SQLite does (`name`, `name:1`, ...)"""
+    names = []
+    for column in description:
+        name, n = column[0], 0
+        while name in names:
+            n += 1
+            name = "{}:{}".format(column[0], n)
+        names.append(name)
+    return names
+
+
+class Federation:
+    """Read connections with every shard attached as `shard_0`, `shard_1`, ..., oldest first
+
+    `groups` are the connections and the schemas attached to each of them,
+    a single connection with `main` when not sharded."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.schemas = [schema for conn, schemas in groups for schema in schemas]
+        self.conn = groups[0][0] if groups else None
+        """the connection of the oldest shards, the only one when not sharded"""
+
+    def query(self, query, parameters=(), outer="SELECT * FROM ({})"):
+        """Rows of `query` of all shards, combined by `outer` (`{}` is the union of them)
+
+        With more than one connection `outer` is run on a table of the rows of all of them,
+        it can only use named parameters and SQLite's own functions then."""
+        if not self.groups:
+            return []
+        if len(self.groups) == 1:
+            conn, schemas = self.groups[0]
+            return conn.execute(outer.replace("{}", federate(query, schemas)), parameters).fetchall()
+
+        with closing(sqlite3.connect(":memory:")) as merged:
+            for i, (conn, schemas) in enumerate(self.groups):
+                c = conn.execute(federate(query, schemas), parameters)
+                if i == 0:
+                    merged.execute("CREATE TABLE `federated` ({})".format(", ".join(
+                        "`{}`".format(name.replace("`", "``")) for name in column_names(c.description)
+                    )))
+                    insert = "INSERT INTO `federated` VALUES ({})".format(", ".join("?" * len(c.description)))
+                merged.executemany(insert, c)
+            return merged.execute(
+                outer.replace("{}", "SELECT * FROM `federated`"),
+                parameters if isinstance(parameters, dict) else ()
+            ).fetchall()
+
+    def close(self):
+        for conn, schemas in self.groups:
+            conn.close()
+
+
+def attach_limit(conn):
+    """Databases SQLite attaches to `conn` at most, Connection.getlimit is new in Python 3.11"""
+    return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, "getlimit") else 10
+
+
+def connect(shard_dir=None, db_name="function-calls.db", profile='read'):
+    """A Federation of the shards in `shard_dir`, or of only `db_name` when not sharded
+
+    Values are read with `decompress_value`, see valueCompression"""
+    if shard_dir is None:
+        conn = storageProfiles.connect(db_name, profile)
+        valueCompression.register(conn)
+        return Federation([(conn, ["main"])])
+
+    paths = shard_paths(shard_dir)
+    groups = []
+    for i, path in enumerate(paths):
+        if not groups or len(groups[-1][1]) == attach_limit(groups[-1][0]):
+            groups.append((sqlite3.connect(":memory:"), []))
+        conn, schemas = groups[-1]
+        schema = "shard_{}".format(i)
+        conn.execute("ATTACH DATABASE ? AS `{}`".format(schema), (path, ))
+        storageProfiles.apply_profile(conn, profile, schema)
+        schemas.append(schema)
+    for conn, schemas in groups:
+        valueCompression.register(conn, schemas)
+    return Federation(groups)
@@ -0,0 +1,55 @@
+"""SQLite settings of the function-calls database, per way it's used.
+
+`ingest` is for collectFunctionCalls.py, which writes one transaction per request,
+`read` for server.py and other readers. In WAL mode readers don't block the writer
+and the writer doesn't block readers, so traces can be imported while the database is in use.
+
+Every profile is a set of pragmas, which can be changed in settings.py:
+
+    storage_profiles = {'ingest': {'mmap_size': 0}}
+"""
+import sqlite3
+
+import settings
+
+STORAGE_PROFILES = {
+    'ingest': {
+        # only have effect before the first table is created (or on VACUUM)
+        'page_size': 16384,
+        # lets retention.py hand pages back a few at a time
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'temp_store': 'MEMORY',
+        # negative sizes are in KiB
+        'cache_size': -262144,
+        'mmap_size': 1024 * 1024 * 1024,
+        # a request holds the write lock until it's committed, see collectFunctionCalls.request_transaction
+        'busy_timeout': 10 * 60 * 1000,
+    },
+    'read': {
+        'query_only': 'ON',
+        'cache_size': -65536,
+        'mmap_size': 1024 * 1024 * 1024,
+    },
+}
+
+
+def profile_pragmas(profile):
+    """The pragmas of a profile, including the overrides of settings.py"""
+    pragmas = dict(STORAGE_PROFILES[profile])
+    pragmas.update(getattr(settings, 'storage_profiles', {}).get(profile, {}))
+    return pragmas
+
+
+def apply_profile(conn, profile, schema=None):
+    """Sets the pragmas of `profile`, only for the attached database `schema` if given"""
+    prefix = "`{}`.".format(schema) if schema else ""
+    for pragma, value in profile_pragmas(profile).items():
+        conn.execute("PRAGMA {}{} = {}".format(prefix, pragma, value))
+
+
+def connect(db_name, profile):
+    conn = sqlite3.connect(db_name)
+    apply_profile(conn, profile)
+    return conn
@@ -2,19 +2,29 @@ import sublime
 import sublime_plugin
 import sqlite3
 import os.path
+import sys
 from pprint import pprint
 from collections import Counter
 import html
 
 settings = sublime.load_settings('MethodUsages.sublime-settings')
 
-db_name = settings.get("db_path")
-conn = sqlite3.connect(db_name)
+# shardedDatabase and what it imports are in the checkout the plugin comes from
+package_path = settings.get("package_path") or os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if package_path not in sys.path:
+    sys.path.append(package_path)
+
+import shardedDatabase
+
+
+def connect():
+    """All shards of `shard_dir` at once, or only `db_path` when it isn't set, see shardedDatabase"""
+    return shardedDatabase.connect(settings.get("shard_dir"), settings.get("db_path"))
 
 
 class ComputedProperty:
-    def __init__(self, conn, word, filename, linenum):
-        self.conn = conn
+    def __init__(self, db, word, filename, linenum):
+        self.db = db
         self.word = word
         self.filename = filename
         self.linenum = linenum
@@ -36,27 +46,24 @@ class IsDeterministicProperty(ComputedProperty):
         """
         query = """
         SELECT
-            group_concat(coalesce(v.value, '{{void}}'), ', ') as params,
-            v2.value as returnval
+            group_concat(coalesce(decompress_value(v.value, v.compression), '{{void}}'), ', ') as params,
+            decompress_value(v2.value, v2.compression) as returnval
         FROM
-            function_invocations f
-            LEFT JOIN `invocation_parameters` parameter on parameter.function_invocation_hash=f.hash
-            LEFT JOIN `values` v on parameter.value_id = v.rowid
-            LEFT JOIN `values` v2 on f.returnval = v2.rowid
+            {shard}.function_invocations f
+            LEFT JOIN {shard}.`invocation_parameters` parameter on parameter.invocation_id=f.id
+            LEFT JOIN {shard}.`values` v on parameter.value_id = v.rowid
+            LEFT JOIN {shard}.`values` v2 on f.returnval = v2.rowid
         WHERE f.name =
             (SELECT fn.rowid
-             FROM function_names fn
+             FROM {shard}.function_names fn
              WHERE
                 fn.name = :word)
-        GROUP BY f.hash
+        GROUP BY f.id
         """
 
-        c = self.conn.cursor()
-        c.execute(query, { 'word': self.word })
-
         hashtable = {}
 
-        for params, returnval in c.fetchall():
+        for params, returnval in self.db.query(query, { 'word': self.word }):
             if params in hashtable:
                 hashtable[params].append(returnval)
             else:
@@ -86,20 +93,17 @@ class ArityProperty(ComputedProperty):
         SELECT
             COUNT(v.value)
         FROM
-            function_invocations f
-            LEFT JOIN `invocation_parameters` parameter on parameter.function_invocation_hash=f.hash
-            LEFT JOIN `values` v on parameter.value_id = v.rowid
+            {shard}.function_invocations f
+            LEFT JOIN {shard}.`invocation_parameters` parameter on parameter.invocation_id=f.id
+            LEFT JOIN {shard}.`values` v on parameter.value_id = v.rowid
         WHERE f.name =
             (SELECT fn.rowid
-             FROM function_names fn
+             FROM {shard}.function_names fn
              WHERE
                 fn.name = :word)
-        GROUP BY f.hash"""
+        GROUP BY f.id"""
 
-        c = self.conn.cursor()
-        c.execute(query, { 'word': self.word })
-
-        return c.fetchall()
+        return self.db.query(query, { 'word': self.word })
 
     def render_html(self):
         arities = [x[0] for x in self.compute()]
@@ -130,20 +134,17 @@ class ReturnTypeProperty(ComputedProperty):
         SELECT DISTINCT
             `vt`.`php_type`
         FROM
-            `function_invocations` `f`
-            LEFT JOIN `values` `v` ON `f`.`returnval`=`v`.`rowid`
-            LEFT JOIN `value_types` `vt` ON `v`.`php_type`=`vt`.`rowid`
+            {shard}.`function_invocations` `f`
+            LEFT JOIN {shard}.`values` `v` ON `f`.`returnval`=`v`.`rowid`
+            LEFT JOIN {shard}.`value_types` `vt` ON `v`.`php_type`=`vt`.`rowid`
         WHERE f.name =
             (SELECT f4.rowid
-             FROM function_names f4
+             FROM {shard}.function_names f4
              WHERE
                 f4.name = :word)
         """
 
-        c = self.conn.cursor()
-        c.execute(query, { 'word': self.word })
-
-        return c.fetchall()
+        return self.db.query(query, { 'word': self.word }, outer="SELECT DISTINCT * FROM ({})")
 
     def render_html(self):
         types = self.compute()
@@ -159,35 +160,37 @@ class MethodUsageExamplesProperty(ComputedProperty):
     def compute(self):
         query = """
         SELECT DISTINCT
-            COALESCE(f2.name, '{{missing fn}}') || '(' || substr(group_concat(coalesce(v.value, '{{void}}'), ', '), 1, 80) || ') -> ' || coalesce(v2.value, '{{void}}') as `function invocation`,
+            COALESCE(f2.name, '{{missing fn}}') || '(' || substr(group_concat(coalesce(decompress_value(v.value, v.compression), '{{void}}'), ', '), 1, 80) || ') -> ' || coalesce(decompress_value(v2.value, v2.compression), '{{void}}') as `function invocation`,
             f3.name LIKE :name as file_sorter,
             ABS(f.linenum - :linenum) as distance,
-            printf("%f", t.value) as time,
-            m.value as memory
+            printf("%f", decompress_value(t.value, t.compression)) as time,
+            decompress_value(m.value, m.compression) as memory
         FROM
-             function_invocations f
-               LEFT JOIN `function_names` f2 ON f.name = f2.rowid
-               LEFT JOIN `file_names` f3 on f.calling_filename = f3.rowid
-               LEFT JOIN `file_names` f4 on f.definition_filename = f4.rowid
-               LEFT JOIN `invocation_parameters` parameter on parameter.function_invocation_hash=f.hash
-               LEFT JOIN `values` v on parameter.value_id = v.rowid
-               LEFT JOIN `values` v2 on f.returnval = v2.rowid
-               LEFT JOIN `values` m on f.memory=m.rowid
-               LEFT JOIN `values` t on f.time=t.rowid
+             {shard}.function_invocations f
+               LEFT JOIN {shard}.`function_names` f2 ON f.name = f2.rowid
+               LEFT JOIN {shard}.`file_names` f3 on f.calling_filename = f3.rowid
+               LEFT JOIN {shard}.`file_names` f4 on f.definition_filename = f4.rowid
+               LEFT JOIN {shard}.`invocation_parameters` parameter on parameter.invocation_id=f.id
+               LEFT JOIN {shard}.`values` v on parameter.value_id = v.rowid
+               LEFT JOIN {shard}.`values` v2 on f.returnval = v2.rowid
+               LEFT JOIN {shard}.`values` m on f.memory=m.rowid
+               LEFT JOIN {shard}.`values` t on f.time=t.rowid
         WHERE f.name =
               (SELECT f4.rowid
-               FROM function_names f4
+               FROM {shard}.function_names f4
                WHERE
                    f4.name = :word)
-        GROUP BY f.hash
+        GROUP BY f.id
         ORDER BY file_sorter DESC, distance ASC
         LIMIT 15
         ;"""
 
-        c = self.conn.cursor()
-        c.execute(query, { 'word': self.word, 'name': '%' + self.filename + '%', 'linenum': self.linenum })
-
-        return c.fetchall()
+        # the 15 best of every shard, of which the 15 best overall
+        return self.db.query(
+            query,
+            { 'word': self.word, 'name': '%' + self.filename + '%', 'linenum': self.linenum },
+            outer="SELECT DISTINCT * FROM ({}) ORDER BY file_sorter DESC, distance ASC LIMIT 15"
+        )
 
     def render_html(self):
         result = self.compute()
@@ -220,10 +223,13 @@ class MethodUsagesCommand(sublime_plugin.TextCommand):
         self.render_html(word, filename, linenum)
 
     def render_html(self, word, filename, linenum):
-        deterministic_html = IsDeterministicProperty(conn, word, filename, linenum).render_html()
-        method_usage_examples = MethodUsageExamplesProperty(conn, word, filename, linenum).render_html()
-        types = ReturnTypeProperty(conn, word, filename, linenum).render_html()
-        arity = ArityProperty(conn, word, filename, linenum).render_html()
+        # connects every time, there might be a new shard
+        db = connect()
+        deterministic_html = IsDeterministicProperty(db, word, filename, linenum).render_html()
+        method_usage_examples = MethodUsageExamplesProperty(db, word, filename, linenum).render_html()
+        types = ReturnTypeProperty(db, word, filename, linenum).render_html()
+        arity = ArityProperty(db, word, filename, linenum).render_html()
+        db.close()
 
         content = """
         <html>
@@ -1,7 +1,19 @@
 import PHPTraceTokenizer
 import PHPProfileParser
 import PHPTraceParser
+import PHPProfileModel
+import PHPTraceTable
+import asyncio
+import contextlib
+import glob
+import io
 import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
 
 
 traceDir = "test-data"
@@ -13,13 +25,151 @@ def trace_and_profile_from_timestamp(traceDir, timestamp):
     )
 
 def create_trace(traceFile, profileFile):
-    function_mappings = PHPProfileParser.get_function_file_mapping(profileFile)
+    function_mappings = PHPProfileParser.get_function_file_mapping([profileFile])
     return PHPTraceTokenizer.Trace(traceFile, function_mappings)
 
 
-def traceNoExceptionsTest(timestamp):
-    traceFile, profileFile = trace_and_profile_from_timestamp(traceDir, timestamp)
+def write_trace(traceFile, seed, calls=200):
+    """A computerized trace (xdebug.trace_format=1) of `calls` random calls, test-data has no traces of its own"""
+    rand = random.Random(seed)
+    names = ["foo", "Bar->baz", "Qux::quux", "strlen", "explode", "array_map", "require_once"]
+    files = ["C:\\app\\index.php", "C:\\app\\lib\\A.php", "C:\\app\\vendor\\\u00fc.php"]
+    values = ["'hello'", "42", "3.5", "array (0 => 'a')", "NULL", "TRUE", "class Foo { public $a = 1 }", "'" + "x" * 300 + "'"]
+    lines = ["Version: 2.6.0", "File format: 4", "TRACE START [2018-11-17 23:42:58]"]
+    state = {'num': 0, 'time': 0.0002, 'memory': 395752}
+
+    def call(level):
+        num = state['num']
+        state['num'] += 1
+        name = "{main}" if num == 0 else rand.choice(names)
+        params = [] if num == 0 else rand.sample(values, rand.randint(0, 3))
+        lines.append("\t".join(
+            [str(level), str(num), "0", "%f" % state['time'], str(state['memory']), name, "1", "", rand.choice(files), str(rand.randint(1, 500)), str(len(params))] + params
+        ))
+        while level < 6 and state['num'] < calls and rand.random() < 0.6:
+            call(level + 1)
+        state['time'] += rand.random() / 1000
+        state['memory'] += rand.randint(-100, 400)
+        lines.append("\t".join([str(level), str(num), "1", "%f" % state['time'], str(state['memory'])]))
+        if num != 0 and rand.random() < 0.8:
+            lines.append("\t".join([str(level), str(num), "R", "", "", rand.choice(values)]))
+
+    while state['num'] < calls:
+        call(1)
+    lines += ["\t\t\t%f\t%d" % (state['time'], state['memory']), "TRACE END   [2018-11-17 23:42:59]", "", ""]
+    with open(traceFile, "w", encoding="utf-8", newline="") as f:
+        f.write("\n".join(lines))
+
+
+def traceNoExceptionsTest(traceFile, profileFile):
     trace = create_trace(traceFile, profileFile)
+    list(trace.parse())
+
+
+def parallelEqualsSequentialTest(trace):
+    """Tokenizing chunks of the trace in other processes gives the same calls"""
+    calls = repr(list(PHPTraceParser.ordered_function_calls(trace)))
+    for processes in (1, 2, 3):
+        assert repr(list(PHPTraceParser.parallel_ordered_function_calls(trace, processes))) == calls, (trace.path, processes)
+
+
+def streamingEqualsSequentialTest(trace):
+    """The streaming parser gives the same calls, in the order they finished"""
+    calls = list(PHPTraceParser.iter_ordered_function_calls(trace))
+    calls.sort(key=lambda call: call['function_num'])
+    assert repr(calls) == repr(list(PHPTraceParser.ordered_function_calls(trace))), trace.path
+
+
+def tableEqualsSequentialTest(trace):
+    table = PHPTraceTable.TraceTable.from_trace(trace)
+    assert repr(PHPTraceTable.ordered_function_calls(table)) == repr(list(PHPTraceParser.ordered_function_calls(trace))), trace.path
+
+
+def profileInclusiveWithinMainTest(profileFile):
+    """No function can take longer than the whole request, recursive ones included"""
+    model = PHPProfileModel.ProfileModel.from_files([profileFile])
+    main = model.inclusive[model.function_id("{main}")]
+    assert (model.inclusive <= main).all(), profileFile
+
+
+def scanDefinitionsEqualsScanAllTest(profileFile):
+    """The fast path of the profile parser finds the same definitions as the slow one"""
+    with open(profileFile, "rb") as f:
+        buffer = f.read()
+    fast, slow = PHPProfileParser.PHPProfilerParser(), PHPProfileParser.PHPProfilerParser()
+    assert fast.scan_definitions(buffer), profileFile
+    slow.scan_all(buffer)
+    assert (fast.files, fast.functions, fast.context) == (slow.files, slow.functions, slow.context), profileFile
+
+
+def import_peak_memory(requestDir, db, processes):
+    """Imports every request in `requestDir` like collectFunctionCalls.py -a -p `processes`
+
+    Returns the peak of what this (the writing) process allocated"""
+    import collectFunctionCalls
+
+    collectFunctionCalls.traceDir = requestDir
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        collectFunctionCalls.run(db, False, None, False, True, asyncio.Queue(), loop, processes=processes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    loop.call_soon_threadsafe(loop.stop)
+    return peak
+
+
+def importParallelEqualsSequentialTest(requestDir, directory):
+    """-p 2 writes the same rows as -p 1, and the writer doesn't hold a whole request in memory to do so"""
+    import collectFunctionCalls
+
+    # many batches per request, the workers stream them to the writer
+    collectFunctionCalls.INSERT_BATCH_SIZE = 100
+    rows = {}
+    peaks = {}
+    for processes in (1, 2):
+        db = os.path.join(directory, "p{}.db".format(processes))
+        peaks[processes] = import_peak_memory(requestDir, db, processes)
+        with contextlib.closing(sqlite3.connect(db)) as conn:
+            rows[processes] = conn.execute("""
+                SELECT `f`.`id`, `fn`.`name`, `d`.`name`, `c`.`name`, `f`.`linenum`, `f`.`requestname`,
+                       (SELECT group_concat(hex(`v`.`value`), ', ') FROM `invocation_parameters` `p` JOIN `values` `v` ON `p`.`value_id` = `v`.`rowid` WHERE `p`.`invocation_id` = `f`.`id`)
+                FROM `function_invocations` `f`
+                    JOIN `function_names` `fn` ON `f`.`name` = `fn`.`rowid`
+                    JOIN `file_names` `d` ON `f`.`definition_filename` = `d`.`rowid`
+                    JOIN `file_names` `c` ON `f`.`calling_filename` = `c`.`rowid`
+                ORDER BY `f`.`id`
+            """).fetchall()
+    assert rows[1] and rows[1] == rows[2]
+    assert peaks[2] < 2 * peaks[1], peaks
+
+
+if __name__ == '__main__':
+    profileFiles = sorted(glob.glob(os.path.join(traceDir, "traces", "*.xp")))
+
+    for profileFile in profileFiles:
+        profileInclusiveWithinMainTest(profileFile)
+        scanDefinitionsEqualsScanAllTest(profileFile)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for seed, profileFile in enumerate(profileFiles):
+            traceFile = os.path.join(directory, "{}.xt".format(seed))
+            write_trace(traceFile, seed)
+            traceNoExceptionsTest(traceFile, profileFile)
+
+            trace = create_trace(traceFile, profileFile)
+            parallelEqualsSequentialTest(trace)
+            streamingEqualsSequentialTest(trace)
+            tableEqualsSequentialTest(trace)
 
+        # requests as xdebug names them, only the first one has a profile
+        requestDir = os.path.join(directory, "requests")
+        os.mkdir(requestDir)
+        for seed in range(4):
+            write_trace(os.path.join(requestDir, "154249817{}_1 R{}.xt".format(seed, seed)), seed, calls=3000)
+        shutil.copy(profileFiles[0], os.path.join(requestDir, "1542498170_1 R0.xp"))
+        importParallelEqualsSequentialTest(requestDir, directory)
 
-traceNoExceptionsTest('1541770537')
\ No newline at end of file
+    print("All tests passed")
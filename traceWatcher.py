@@ -0,0 +1,278 @@
+"""Knowing when the files xdebug writes to the trace directory are complete.
+
+On Linux `TraceWatcher` is told about new files by the kernel (inotify), instead of
+listing the directory over and over: a request is ready once its files were closed
+after writing, or moved into the directory, and none of them changed for a moment.
+
+    with TraceWatcher(traceDir, request_id) as watcher:
+        while True:
+            for key in watcher.wait():
+                print(key, watcher.files[key])
+
+Whether another process (apache) still has a file open is checked through /proc on Linux.
+Where that can't be seen (other platforms, processes of other users) a file is
+assumed to be complete once it wasn't modified for a moment, and, for traces, once
+xdebug wrote their `TRACE END` footer.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from collections import deque
+
+import PHPTraceFiles
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+"""struct inotify_event without its name: wd, mask, cookie, len"""
+
+EVENT_BUFFER_SIZE = 64 * 1024
+
+DEBOUNCE_SECONDS = 0.2
+"""Requests often write more than one file (a trace and a profile), they're handed out together"""
+
+STABLE_SECONDS = 1.0
+"""How long a file mustn't have been modified for `file_is_settled`"""
+
+TRACE_END = b"TRACE END"
+"""What the footer xdebug writes when a trace is closed starts with"""
+
+FOOTER_SIZE = 4096
+"""How much of the end of an uncompressed trace `trace_has_ended` reads"""
+
+_libc = None
+
+
+def _inotify_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+def available():
+    """Whether TraceWatcher can be used on this platform"""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        return hasattr(_inotify_libc(), "inotify_init1")
+    except OSError:
+        return False
+
+
+class TraceWatcher:
+    """The files of a directory grouped by `key` (request id), and the keys whose files were completed
+
+    Names for which `key` returns None are ignored."""
+
+    def __init__(self, directory, key, debounce=DEBOUNCE_SECONDS):
+        self.directory = directory
+        self.key = key
+        self.debounce = debounce
+
+        self.files = {}
+        """key > names of its files in the directory"""
+
+        self.writing = set()
+        """Names of the files that were created and not closed yet"""
+
+        self.changed = {}
+        """key > time.monotonic() of the last file of it that was completed"""
+
+        self.overflowed = False
+
+        libc = _inotify_libc()
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: {}".format(os.strerror(errno)))
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch: {}".format(os.strerror(errno)), directory)
+
+        # only after the watch is set up, so no file falls in between
+        self.rescan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def rescan(self):
+        self.files = {}
+        for name in os.listdir(self.directory):
+            self._add(name)
+
+    def _add(self, name):
+        key = self.key(name)
+        if key is not None:
+            self.files.setdefault(key, set()).add(name)
+        return key
+
+    def _remove(self, name):
+        self.writing.discard(name)
+        key = self.key(name)
+        names = self.files.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self.files[key]
+                self.changed.pop(key, None)
+
+    def writing_keys(self):
+        """Keys of the requests that are still being written"""
+        return {self.key(name) for name in self.writing}
+
+    def filenames(self, keys):
+        return [name for key in keys for name in self.files.get(key, ())]
+
+    def wait(self, timeout=None):
+        """Keys of requests whose files were completed, once none of their files changed for `debounce` seconds
+
+        Gives up after `timeout` seconds, with an empty list.
+        Returns None when the kernel dropped events, the whole directory has to be looked at again"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.overflowed:
+                self.overflowed = False
+                self.writing.clear()
+                self.changed.clear()
+                self.rescan()
+                return None
+
+            now = time.monotonic()
+            writing = self.writing_keys()
+            pending = {key: changed for key, changed in self.changed.items() if key not in writing}
+            ready = [key for key, changed in pending.items() if now - changed >= self.debounce]
+            if ready:
+                for key in ready:
+                    del self.changed[key]
+                return ready
+
+            if deadline is not None and now >= deadline:
+                return []
+
+            waits = [self.debounce - (now - changed) for changed in pending.values()]
+            if deadline is not None:
+                waits.append(deadline - now)
+            self.read(min(waits) if waits else None)
+
+    def read(self, timeout=None):
+        """Handles the events that arrive within `timeout` seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            self.event(mask, name)
+
+    def event(self, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+        elif mask & (IN_DELETE_SELF | IN_IGNORED):
+            raise FileNotFoundError("The watched directory is gone", self.directory)
+        elif mask & IN_ISDIR or not name:
+            return
+        elif mask & IN_CREATE:
+            if self._add(name) is not None:
+                self.writing.add(name)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.writing.discard(name)
+            key = self._add(name)
+            if key is not None:
+                self.changed[key] = time.monotonic()
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._remove(name)
+
+
+def files_in_use():
+    """Paths of the files other processes have open through /proc/<pid>/fd, and whether all processes could be looked at
+
+    The files of processes of other users can't be seen without being root, those are skipped.
+    None where there's no /proc"""
+    if not sys.platform.startswith("linux"):
+        return None
+
+    own = str(os.getpid())
+    paths = set()
+    complete = True
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or pid == own:
+            continue
+
+        fd_dir = os.path.join("/proc", pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except FileNotFoundError:
+            # exited in the meantime
+            continue
+        except PermissionError:
+            complete = False
+            continue
+
+        for fd in fds:
+            try:
+                paths.add(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                pass
+    return paths, complete
+
+
+def file_is_settled(path):
+    """Whether a file wasn't modified for STABLE_SECONDS, for when it can't be seen if it's still open"""
+    try:
+        return time.time() - os.stat(path).st_mtime >= STABLE_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def trace_has_ended(path):
+    """Whether xdebug wrote the `TRACE END` footer of a trace, which it only does when the request is done
+
+    A request that pauses (sleep, a slow query) doesn't modify its trace for a while,
+    being settled alone doesn't make a trace complete.
+    Compressed traces are read through, their end can't be decompressed on its own."""
+    try:
+        if PHPTraceFiles.is_compressed(path):
+            with PHPTraceFiles.open_binary(path) as f:
+                last_lines = deque(f, maxlen=4)
+        else:
+            with open(path, "rb") as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - FOOTER_SIZE))
+                last_lines = f.read().splitlines()[-4:]
+    except (OSError, EOFError):
+        # gone, or a compressed stream that isn't finished yet
+        return False
+    return any(line.startswith(TRACE_END) for line in last_lines)
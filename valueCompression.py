@@ -0,0 +1,215 @@
+"""Compressed storage of large `values`.
+
+Serialized arrays and objects take up most of the database and look a lot alike,
+so values of at least COMPRESS_MIN_LENGTH characters are stored deflated, with a
+preset dictionary trained on the values of the database itself. `values`.`compression` is
+
+    NULL  the value is stored as is
+    0     deflated without a dictionary, before there were enough values to train one
+    id    deflated with the dictionary of that id in `compression_dictionaries`
+
+Dictionary ids are a hash of the dictionary, so they're the same in every shard.
+Queries read values with the `decompress_value` SQL function, which `register`
+adds to a connection (shardedDatabase.connect does):
+
+    SELECT decompress_value(`v`.`value`, `v`.`compression`) FROM `values` `v`
+
+For queries by hand (see queries.md), and to compress the values of an older database:
+
+    python3 valueCompression.py --db function-calls.db "SELECT ..."
+    python3 valueCompression.py --db function-calls.db --compress-existing
+"""
+import argparse
+import hashlib
+import sqlite3
+import zlib
+from collections import Counter
+
+COMPRESS_MIN_LENGTH = 128
+"""Shorter values are stored as is, they'd barely get smaller"""
+
+DICTIONARY_SIZE = 32 * 1024
+"""Deflate can't refer back further than 32KiB, a larger dictionary is of no use"""
+
+TRAINING_MIN_SAMPLES = 256
+"""Large values a batch needs before a dictionary is trained on them"""
+
+TRAINING_MAX_SAMPLES = 2000
+
+SEGMENT_LENGTH = 16
+
+COMPRESSION_LEVEL = 6
+
+# raw deflate, the zlib header and checksum would take 6 bytes of every value
+WBITS = -15
+
+UPDATE_BATCH_SIZE = 10000
+"""Values compressed per transaction by `compress_existing`"""
+
+parser = argparse.ArgumentParser(description="Query the function-calls database with decompress_value(), or compress its values")
+parser.add_argument('-d', '--db', nargs="?", dest="db", type=str, default="function-calls.db", help="name of the sqlite3 .db file")
+parser.add_argument('--compress-existing', action="store_true", dest="compress_existing", default=False, help="Compress the values stored before compression")
+parser.add_argument('query', nargs="?", type=str, default=None, help="SQL to run, its rows are printed tab separated")
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """A preset dictionary of the segments that most samples have in common
+
+    Every SEGMENT_LENGTH bytes long segment is counted once per sample, the
+    most common ones end up last, where deflate reaches them with the shortest distances"""
+    counts = Counter()
+    for sample in samples[:TRAINING_MAX_SAMPLES]:
+        counts.update({sample[i:i + SEGMENT_LENGTH] for i in range(0, len(sample) - SEGMENT_LENGTH + 1, 4)})
+
+    segments = []
+    length = 0
+    for segment, count in counts.most_common():
+        if count < 2 or length + len(segment) > size:
+            break
+        segments.append(segment)
+        length += len(segment)
+
+    return b"".join(reversed(segments))
+
+
+def dictionary_id(dictionary):
+    """Signed 64-bit, like collectFunctionCalls.value_hash, never 0 or NULL"""
+    return int.from_bytes(hashlib.blake2b(dictionary, digest_size=8).digest(), "little", signed=True) or 1
+
+
+def compress(value, dictionary=None):
+    if dictionary:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, WBITS)
+    return compressor.compress(value.encode("utf-8", "surrogateescape")) + compressor.flush()
+
+
+def decompress(data, dictionary=None):
+    if dictionary:
+        decompressor = zlib.decompressobj(WBITS, zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj(WBITS)
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8", "surrogateescape")
+
+
+def load_dictionaries(conn, schemas=("main", )):
+    """id > dictionary of every (attached) database"""
+    dictionaries = {}
+    for schema in schemas:
+        try:
+            dictionaries.update(conn.execute("SELECT `id`, `dictionary` FROM `{}`.`compression_dictionaries`".format(schema)))
+        except sqlite3.OperationalError:
+            # a database from before compression
+            pass
+    return dictionaries
+
+
+def register(conn, schemas=("main", )):
+    """Adds the `decompress_value(value, compression)` SQL function to a connection"""
+    dictionaries = load_dictionaries(conn, schemas)
+
+    def decompress_value(value, compression):
+        if compression is None:
+            return value
+        if compression and compression not in dictionaries:
+            # trained after this connection was opened
+            dictionaries.update(load_dictionaries(conn, schemas))
+        return decompress(value, dictionaries.get(compression))
+
+    conn.create_function("decompress_value", 2, decompress_value, deterministic=True)
+
+
+class ValueCompressor:
+    """Turns the values written to a database into what's stored, see InternTable"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        row = conn.execute("SELECT `id`, `dictionary` FROM `compression_dictionaries` ORDER BY `rowid` DESC LIMIT 1").fetchone()
+        self.dictionary_id, self.dictionary = row if row else (0, None)
+        self.dictionaries = load_dictionaries(conn)
+
+    def train(self, values):
+        """Trains the database's first dictionary on the large ones of `values`, once there are enough of them"""
+        if self.dictionary is not None:
+            return
+
+        samples = [
+            value.encode("utf-8", "surrogateescape") for value in values
+            if isinstance(value, str) and len(value) >= COMPRESS_MIN_LENGTH
+        ]
+        if len(samples) < TRAINING_MIN_SAMPLES:
+            return
+
+        dictionary = train_dictionary(samples)
+        self.dictionary_id = dictionary_id(dictionary)
+        self.dictionary = self.dictionaries[self.dictionary_id] = dictionary
+        self.conn.execute(
+            "INSERT OR IGNORE INTO `compression_dictionaries` (`id`, `dictionary`) VALUES (?, ?)",
+            (self.dictionary_id, dictionary)
+        )
+
+    def compress(self, value):
+        """(what's stored in `value`, `compression`)"""
+        if not isinstance(value, str) or len(value) < COMPRESS_MIN_LENGTH:
+            return value, None
+
+        data = compress(value, self.dictionary)
+        if len(data) >= len(value):
+            return value, None
+        return data, self.dictionary_id
+
+    def decompress(self, value, compression):
+        if compression is None:
+            return value
+        return decompress(value, self.dictionaries.get(compression))
+
+
+def compress_existing(conn):
+    """Compresses the large values that are stored as is, UPDATE_BATCH_SIZE per transaction
+
+    Returns the number of values compressed"""
+    c = conn.cursor()
+    compressor = ValueCompressor(conn)
+    if compressor.dictionary is None:
+        c.execute(
+            "SELECT `value` FROM `values` WHERE `compression` IS NULL AND LENGTH(`value`) >= ? LIMIT ?",
+            (COMPRESS_MIN_LENGTH, TRAINING_MAX_SAMPLES)
+        )
+        compressor.train([value for value, in c.fetchall()])
+        conn.commit()
+
+    compressed = 0
+    last_rowid = 0
+    while True:
+        c.execute(
+            "SELECT `rowid`, `value` FROM `values` WHERE `rowid` > ? AND `compression` IS NULL AND LENGTH(`value`) >= ? ORDER BY `rowid` LIMIT ?",
+            (last_rowid, COMPRESS_MIN_LENGTH, UPDATE_BATCH_SIZE)
+        )
+        rows = c.fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+
+        updates = [compressor.compress(value) + (rowid, ) for rowid, value in rows]
+        updates = [update for update in updates if update[1] is not None]
+        c.executemany("UPDATE `values` SET `value`=?, `compression`=? WHERE `rowid`=?", updates)
+        conn.commit()
+        compressed += len(updates)
+
+    return compressed
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+
+    if args.compress_existing:
+        print("Compressed {} values, the file only shrinks after a VACUUM (or retention.py)".format(compress_existing(conn)))
+
+    if args.query:
+        register(conn)
+        for row in conn.execute(args.query):
+            print("\t".join("" if column is None else str(column) for column in row))
+
+    conn.close()